@@ -2,14 +2,226 @@ import streamlit as st
 import os
 import time
 import logging
-import copy
-import shutil
-from moviepy import VideoFileClip, ImageClip, CompositeVideoClip, concatenate_videoclips
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Import core engine and vocab functions
 import video_engine
 from vocab_functions import generate_vocab_assets, create_vocab_video_sequence
 
+# Each widget update is a websocket frame; cap per-item progress ticks at ~4 Hz.
+UI_MIN_INTERVAL = 0.25
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def clean_html_cached(raw_html):
+    """
+    clean_html_content memoized on the HTML, so reruns don't re-parse it.
+    """
+    return video_engine.clean_html_content(raw_html)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def generate_dual_scripts_cached(source_text, gemini_model):
+    """
+    generate_dual_scripts memoized on text + model, the only config it reads,
+    so UI toggles (music, debug) don't trigger a new Gemini call.
+    A failed generation raises instead of returning, so it is not cached.
+    """
+    social, web = video_engine.generate_dual_scripts(source_text, {'gemini_model': gemini_model})
+    if not web:
+        raise ValueError("Script generation returned no lines.")
+    return social, web
+
+def make_status_callback(status_text, progress_bar):
+    """
+    Builds a progress callback bound to one status text + progress bar pair.
+    Stage changes (a new status text) and completion always go through.
+    The bar only moves in whole percents, so repeats of the same percent are dropped.
+    """
+    last_ui_update = [0.0]
+    last_percent = [-1]
+
+    def update_status_callback(progress, text=None):
+        now = time.monotonic()
+        percent = int(min(max(progress, 0.0), 1.0) * 100)
+        if not text and progress < 1.0 and (now - last_ui_update[0] < UI_MIN_INTERVAL or percent == last_percent[0]):
+            return
+        last_ui_update[0] = now
+
+        if text:
+            # Simple ETR calculation could go here if persistent state was tracked, 
+            # for now just update text/bar to keep it clean.
+            status_text.text(text)
+        if percent != last_percent[0]:
+            progress_bar.progress(percent)
+            last_percent[0] = percent
+
+    return update_status_callback
+
+def run_social_pipeline(social_script, vocab_list, lesson_title, config, update_status, box):
+    """
+    Social Video: Intro -> Listening (masked) -> Separator -> Reading -> Vocab.
+    social_script must already carry its audio (see main).
+    """
+    try:
+        # 1. Roster
+        update_status(0.05, "Social: Determining Roster...")
+        roster = video_engine.get_active_roster(social_script, config)
+        
+        # 2. Listening (Masked) + Reading (Normal) Parts: two independent encodes, run side by side
+        update_status(0.10, "Social: Assembling Listening & Reading Parts...")
+        part_progress = [0.0, 0.0]
+        
+        def report_part(index):
+            def callback(p):
+                part_progress[index] = p
+                update_status(0.10 + (sum(part_progress) / 2) * 0.7)
+            return callback
+        
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(
+            max_workers=2,
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+        ) as executor:
+            listening_future = executor.submit(
+                video_engine.assemble_video,
+                social_script, roster,
+                output_dir="output", 
+                output_filename="listening_part.mp4",
+                progress_callback=report_part(0),
+                config=config,
+                masked_text=video_engine.MASKED_TEXT
+            )
+            reading_future = executor.submit(
+                video_engine.assemble_video,
+                social_script, roster,
+                output_dir="output",
+                output_filename="reading_part.mp4",
+                progress_callback=report_part(1),
+                config=config
+            )
+        listening_video_path = listening_future.result()
+        reading_video_path = reading_future.result()
+        
+        # 3. Final Composition (APP Logic)
+        update_status(0.80, "Social: Assembling Final Clip...")
+        
+        temp_dir = os.path.join("output", "temp")
+        final_clips = []
+        
+        # Intro (last 0.3s trimmed)
+        intro_path = video_engine.get_intro_clip()
+        if intro_path:
+            final_clips.append({"path": intro_path, "trim_end": 0.3})
+        
+        # Listening
+        if listening_video_path and os.path.exists(listening_video_path):
+            final_clips.append({"path": listening_video_path})
+        
+        # Separator
+        sep_path = video_engine.encode_still_segment(
+            video_engine.create_separator_img(config),
+            os.path.join(temp_dir, "separator.mp4"),
+            duration=1.0,
+            config=config
+        )
+        if sep_path: final_clips.append({"path": sep_path})
+        
+        # Reading
+        if reading_video_path and os.path.exists(reading_video_path):
+            final_clips.append({"path": reading_video_path})
+        
+        # Vocab (Conditional)
+        if vocab_list:
+            vocab_assets = generate_vocab_assets(vocab_list)
+            if vocab_assets:
+                vocab_path = create_vocab_video_sequence(vocab_assets, os.path.join(temp_dir, "vocab.mp4"), config)
+                if vocab_path: final_clips.append({"path": vocab_path})
+        
+        # Concatenate + Branding + Music + Social Title Overlay (Text Flash) in one ffmpeg pass
+        if final_clips:
+            music_path = video_engine.pick_background_music("assets") if config.get("ENABLE_MUSIC") else None
+            title_social_img = video_engine.create_social_title_img(lesson_title, config)
+                
+            # Export
+            update_status(0.90, "Social: Exporting MP4...")
+            social_output_path = os.path.abspath(os.path.join("output", "final_video_complete.mp4"))
+
+            social_output_path = video_engine.compose_video(
+                final_clips,
+                social_output_path,
+                config,
+                overlay_path="assets/NoBackground.png",
+                title_overlay=title_social_img,
+                music_path=music_path
+            )
+            
+            if social_output_path:
+                update_status(1.0, "Social: Done!")
+                box.success("Social Video Generated!")
+                box.video(social_output_path)
+            else:
+                box.error("Failed to export Social Video.")
+        else:
+            box.error("No clips to assemble for Social Video.")
+
+    except Exception as e:
+        box.error(f"Social Video Failed: {e}")
+        logging.error("Social Video Failed", exc_info=True)
+
+def run_web_pipeline(web_script, lesson_title, config, update_status, box):
+    """
+    Web Video: Title Card -> Full Story.
+    web_script must already carry its audio (see main).
+    """
+    try:
+        # 1. Roster
+        web_roster = video_engine.get_active_roster(web_script, config)
+        
+        # 2. Frames + Story (frames are piped straight into the encoder)
+        update_status(0.40, "Web: Assembling Story...")
+        story_path = video_engine.assemble_video(
+            web_script, web_roster,
+            output_dir="output",
+            output_filename="temp_web_story.mp4",
+            progress_callback=lambda p: update_status(0.40 + (p * 0.45)),
+            config=config
+        )
+        
+        if story_path:
+            # 3. Title Card & Composition (stream copy, no re-encode of the story)
+            final_web_clips = []
+            
+            title_card_img = video_engine.create_title_card(lesson_title, config)
+            title_card_path = video_engine.encode_still_segment(
+                title_card_img,
+                os.path.join("output", "temp", "title_card.mp4"),
+                duration=3.0,
+                config=config
+            )
+            if title_card_path: final_web_clips.append(title_card_path)
+            
+            final_web_clips.append(story_path)
+            
+            # Export
+            update_status(0.85, "Web: Exporting MP4...")
+            web_output_path = os.path.abspath(os.path.join("output", "Web_Video.mp4"))
+
+            web_output_path = video_engine.concat_videos(final_web_clips, web_output_path, config)
+            
+            if web_output_path:
+                update_status(1.0, "Web: Done!")
+                box.success("Web Video Generated!")
+                box.video(web_output_path)
+            else:
+                box.error("Failed to export Web Video.")
+        else:
+            box.error("Failed to assemble Web Video story.")
+            
+    except Exception as e:
+        box.error(f"Web Video Failed: {e}")
+        logging.error("Web Video Failed", exc_info=True)
+
 def main():
     st.set_page_config(page_title="Visual Novel Video Generator")
 
@@ -33,9 +245,9 @@ def main():
     if st.sidebar.button("Test Audio Generation"):
         with st.spinner("Testing Audio..."):
             # Test with Narrator
-            path_n, dur_n = video_engine.generate_single_audio("This is a test of the narrator voice.", "Narrator", 999, config)
-            if path_n:
-                st.sidebar.audio(path_n)
+            pcm_n, dur_n = video_engine.generate_single_audio("This is a test of the narrator voice.", "Narrator", 999, config)
+            if pcm_n:
+                st.sidebar.audio(video_engine.pcm_to_wav(pcm_n), format="audio/wav")
                 st.sidebar.success(f"Narrator: {dur_n:.2f}s")
     
     # --- Main UI ---
@@ -45,12 +257,7 @@ def main():
     status_text = st.empty()
     main_progress = st.progress(0)
     
-    def update_status_callback(progress, text=None):
-        if text:
-            # Simple ETR calculation could go here if persistent state was tracked, 
-            # for now just update text/bar to keep it clean.
-            status_text.text(text)
-        main_progress.progress(progress)
+    update_status_callback = make_status_callback(status_text, main_progress)
 
     # 1. HTML Input
     raw_html = st.text_area("Paste Lesson HTML", height=300, placeholder="Paste the full lesson HTML code here...")
@@ -58,7 +265,7 @@ def main():
     # Button: Clean
     if st.button("Clean & Preview Text"):
         with st.spinner("Cleaning HTML..."):
-            cleaned_text, vocab_list, lesson_title = video_engine.clean_html_content(raw_html)
+            cleaned_text, vocab_list, lesson_title = clean_html_cached(raw_html)
             
             # Update Session State
             st.session_state.cleaned_text_preview = cleaned_text
@@ -99,14 +306,13 @@ def main():
             source_text = st.session_state.get('original_clean_text', final_script_text)
             
             with st.spinner("Generating Web Script..."):
-                social, web = video_engine.generate_dual_scripts(source_text, config)
-                
-                if web:
+                try:
+                    social, web = generate_dual_scripts_cached(source_text, config.get('gemini_model', 'gemini-pro'))
                     st.session_state.script_web = web
                     # Auto-derive Social Script (First 6 lines)
                     st.session_state.script_social = web[:6]
                     st.success("Web Script & Social Teaser Generated!")
-                else:
+                except ValueError:
                     st.error("Failed to generate scripts.")
 
         # Script Editors
@@ -134,193 +340,44 @@ def main():
         if st.button("Generate Video"):
             # --- START GENERATION ORCHESTRATION ---
             
+            # Snapshot inputs on the script thread; the workers never touch session_state.
+            # Lines are flat dicts and generate_audio only adds keys, so copying each dict is enough.
+            script_web = [dict(line) for line in st.session_state.script_web]
+            vocab_list = st.session_state.get('vocab_list')
+            lesson_title = st.session_state.lesson_title
 
-            
-            # Get Codec Settings
-            video_codec = config.get('settings', {}).get('video_codec', 'libx264')
-            write_kwargs = {"codec": video_codec, "audio_codec": "aac", "logger": None}
-            
-            # Safety Check for Hardware Encoders
-            if video_codec != "libx264":
-                write_kwargs["preset"] = "p4"
+            # Each pipeline reports into its own section so concurrent updates don't interleave.
+            social_col, web_col = st.columns(2)
+            social_col.subheader("Social Video")
+            web_col.subheader("Web Video")
+            social_status = make_status_callback(social_col.empty(), social_col.progress(0))
+            web_status = make_status_callback(web_col.empty(), web_col.progress(0))
 
-            # --- A. SOCIAL VIDEO (Complex Sequence) ---
-            st.subheader("Generating Social Video...")
-            social_script = copy.deepcopy(st.session_state.script_social)
-            
-            try:
-                # 1. Roster
-                update_status_callback(0.05, "Social: Determining Roster...")
-                roster = video_engine.get_active_roster(social_script, config)
-                
-                # 2. Audio
-                update_status_callback(0.10, "Social: Generating Audio...")
-                # Pass lambda directly to capture progress within the sub-range 0.1->0.2
-                social_script = video_engine.generate_audio(
-                    social_script, 
-                    config, 
-                    output_dir="output", # Shared output for audio? Or distinct? Engine uses "output" default.
-                    progress_callback=lambda p: update_status_callback(0.10 + (p * 0.1))
-                )
-                
-                # 3. Listening Part (Masked)
-                update_status_callback(0.20, "Social: Generating Listening Part...")
-                listening_script = copy.deepcopy(social_script)
-                for line in listening_script:
-                    if 'text' in line: line['text'] = "..... ? ....."
-                
-                video_engine.generate_frames(
-                    listening_script, roster, config, 
-                    output_dir="output/frames_listening",
-                    progress_callback=lambda p: update_status_callback(0.20 + (p * 0.1))
-                )
-                
-                listening_video_path = video_engine.assemble_video(
-                    listening_script, 
-                    output_dir="output", 
-                    output_filename="listening_part.mp4",
-                    config=config
-                )
-                
-                # 4. Reading Part (Normal)
-                update_status_callback(0.35, "Social: Generating Reading Part...")
-                video_engine.generate_frames(
-                    social_script, roster, config,
-                    output_dir="output/frames_reading",
-                    progress_callback=lambda p: update_status_callback(0.35 + (p * 0.1))
-                )
-                
-                reading_video_path = video_engine.assemble_video(
-                    social_script,
-                    output_dir="output",
-                    output_filename="reading_part.mp4",
-                    config=config
-                )
-                
-                # 5. Final Composition (APP Logic)
-                update_status_callback(0.50, "Social: Assembling Final Clip...")
-                
-                final_clips = []
-                
-                # Intro
-                if os.path.exists("assets/intro.mp4"):
-                    intro = VideoFileClip("assets/intro.mp4").resized(new_size=(1080, 1920))
-                    if intro.duration > 1:
-                        intro = intro.subclipped(0, intro.duration - 0.3)
-                    final_clips.append(intro)
-                
-                # Listening
-                if listening_video_path and os.path.exists(listening_video_path):
-                    final_clips.append(VideoFileClip(listening_video_path))
-                
-                # Separator
-                sep_clip = video_engine.create_separator_clip(config, "output")
-                if sep_clip: final_clips.append(sep_clip)
-                
-                # Reading
-                if reading_video_path and os.path.exists(reading_video_path):
-                    final_clips.append(VideoFileClip(reading_video_path))
-                
-                # Vocab (Conditional)
-                if st.session_state.get('vocab_list'):
-                    vocab_assets = generate_vocab_assets(st.session_state.vocab_list)
-                    if vocab_assets:
-                        vocab_clip = create_vocab_video_sequence(vocab_assets)
-                        if vocab_clip: final_clips.append(vocab_clip)
-                
-                # Concatenate
-                if final_clips:
-                    final_combined = concatenate_videoclips(final_clips)
-                    
-                    # Branding
-                    if os.path.exists("assets/NoBackground.png"):
-                        overlay = ImageClip("assets/NoBackground.png")\
-                            .with_duration(final_combined.duration)\
-                            .with_position(('center', 'bottom'))
-                        final_combined = CompositeVideoClip([final_combined, overlay])
-                    
-                    # Music
-                    if config.get("ENABLE_MUSIC"):
-                        final_combined = video_engine.add_background_music(final_combined, "assets")
-                    
-                    # Social Title Overlay (Text Flash)
-                    title_social_path = video_engine.create_social_title_img(st.session_state.lesson_title, config)
-                    if os.path.exists(title_social_path):
-                        title_overlay = ImageClip(title_social_path).with_duration(1.0).with_start(0)
-                        final_combined = CompositeVideoClip([final_combined, title_overlay])
-                        
-                    # Export
-                    update_status_callback(0.55, "Social: Exporting MP4...")
-                    social_output_path = os.path.abspath(os.path.join("output", "final_video_complete.mp4"))
+            update_status_callback(0.0, "Generating Social & Web videos...")
 
-                    final_combined.write_videofile(social_output_path, **write_kwargs)
-                    
-                    st.success("Social Video Generated!")
-                    st.video(social_output_path)
-                else:
-                    st.error("No clips to assemble for Social Video.")
-
-            except Exception as e:
-                st.error(f"Social Video Failed: {e}")
-                logging.error("Social Video Failed", exc_info=True)
-
-
-            # --- B. WEB VIDEO (Simple Sequence) ---
-            st.subheader("Generating Web Video...")
-            web_script = copy.deepcopy(st.session_state.script_web)
-            
-            try:
-                # 1. Roster
-                web_roster = video_engine.get_active_roster(web_script, config)
-                
-                # 2. Audio
-                update_status_callback(0.65, "Web: Generating Audio...")
-                web_script = video_engine.generate_audio(
-                    web_script, config,
-                    output_dir="output/audio_web",
-                    progress_callback=lambda p: update_status_callback(0.65 + (p * 0.1))
-                )
-                
-                # 3. Frames
-                update_status_callback(0.75, "Web: Generating Frames...")
-                video_engine.generate_frames(
-                    web_script, web_roster, config,
-                    output_dir="output/frames_web",
-                    progress_callback=lambda p: update_status_callback(0.75 + (p * 0.1))
-                )
-                
-                # 4. Assemble Story
-                story_path = video_engine.assemble_video(
-                    web_script,
-                    output_dir="output",
-                    output_filename="temp_web_story.mp4",
-                    config=config
-                )
-                
-                if story_path:
-                    # 5. Title Card & Composition
-                    final_web_clips = []
-                    
-                    title_card_path = video_engine.create_title_card(st.session_state.lesson_title, config)
-                    if os.path.exists(title_card_path):
-                        final_web_clips.append(ImageClip(title_card_path).with_duration(3.0))
-                    
-                    final_web_clips.append(VideoFileClip(story_path))
-                    
-                    final_web = concatenate_videoclips(final_web_clips)
-                    
-                    # Export
-                    update_status_callback(0.95, "Web: Exporting MP4...")
-                    web_output_path = os.path.abspath(os.path.join("output", "Web_Video.mp4"))
+            # Audio once, before the pipelines split: the Social teaser is the first lines
+            # of the Web story, so it reuses their PCM instead of racing to synthesize it again.
+            social_status(0.0, "Social: Waiting for Audio...")
+            web_status(0.0, "Web: Generating Audio...")
+            script_web = video_engine.generate_audio(
+                script_web, config,
+                progress_callback=lambda p: web_status(p * 0.4)
+            )
+            script_social = [dict(line) for line in script_web[:6]]
 
-                    final_web.write_videofile(web_output_path, **write_kwargs)
-                    
-                    st.success("Web Video Generated!")
-                    st.video(web_output_path)
-                    
-            except Exception as e:
-                st.error(f"Web Video Failed: {e}")
-                logging.error("Web Video Failed", exc_info=True)
+            # Both pipelines are dominated by blocking ffmpeg calls, so two threads let the
+            # Web frames + encode overlap with the Social encode. Workers need the
+            # script run context to be allowed to write to the page.
+            ctx = get_script_run_ctx()
+            with ThreadPoolExecutor(
+                max_workers=2,
+                initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+            ) as executor:
+                futures = [
+                    executor.submit(run_social_pipeline, script_social, vocab_list, lesson_title, config, social_status, social_col),
+                    executor.submit(run_web_pipeline, script_web, lesson_title, config, web_status, web_col),
+                ]
+                wait(futures)
                 
             update_status_callback(1.0, "All Done!")
             
@@ -1,10 +1,9 @@
 import os
 import glob
 import logging
-import copy
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from moviepy import VideoFileClip, ImageClip, CompositeVideoClip, concatenate_videoclips
 import sys
 from types import ModuleType
 
@@ -35,231 +34,229 @@ def setup_logging():
 
 logger = setup_logging()
 
-def main():
-    # 1. Setup
-    logger.info("Starting Batch Generator...")
-    config = video_engine.load_config()
+def prepare_shared_clips(config: dict, output_dir: str) -> dict:
+    """
+    Renders the lesson-independent Social clips once for the whole batch:
+    the separator and the intro already scaled to the output size.
+    """
+    shared_dir = os.path.join(output_dir, "shared")
+    shared = {}
     
-    input_dir = "./input_lessons"
-    output_dir = "./output"
+    shared["separator"] = video_engine.encode_still_segment(
+        video_engine.create_separator_img(config),
+        os.path.join(shared_dir, "separator.mp4"),
+        duration=1.0,
+        config=config
+    )
     
-    os.makedirs(input_dir, exist_ok=True)
-    os.makedirs(output_dir, exist_ok=True)
+    shared["intro"] = video_engine.get_intro_clip()
     
-    # 2. File Loop
-    files = glob.glob(os.path.join(input_dir, "*.txt"))
-    if not files:
-        logger.warning(f"No .txt files found in {input_dir}. Please add some lesson files.")
-        return
-
-    logger.info(f"Found {len(files)} files to process.")
+    return shared
 
-    for file_path in files:
-        filename = os.path.basename(file_path)
-        lesson_id = os.path.splitext(filename)[0]
+def process_lesson(file_path: str, config: dict, output_dir: str, shared_clips: dict) -> None:
+    """
+    Generates the Web and Social videos for one lesson file.
+    Intermediates live in output/<lesson_id>/ so lessons can run in parallel.
+    """
+    filename = os.path.basename(file_path)
+    lesson_id = os.path.splitext(filename)[0]
+    
+    # Per-lesson workspace: parallel workers must not share frames/, temp/ etc.
+    # Kept under work/ so a lesson id can never collide with shared/ or tts_cache/.
+    work_dir = os.path.join(output_dir, "work", lesson_id)
+    vocab_temp_dir = os.path.join(work_dir, "vocab_temp")
+    
+    logger.info(f"[{filename}] Processing Lesson ID: {lesson_id}...")
+    
+    try:
+        # 3. Processing (Replicate App Logic)
         
-        logger.info(f"[{filename}] Processing Lesson ID: {lesson_id}...")
+        # Read Content
+        with open(file_path, 'r', encoding='utf-8') as f:
+            raw_html = f.read()
         
-        try:
-            # 3. Processing (Replicate App Logic)
-            
-            # Read Content
-            with open(file_path, 'r', encoding='utf-8') as f:
-                raw_html = f.read()
-            
-            # Parse
-            logger.info(f"[{filename}] Cleaning HTML content...")
-            cleaned_text, vocab_list, lesson_title = video_engine.clean_html_content(raw_html)
-            
-            logger.info(f"[{filename}] Generating scripts (Web & Social)...")
-            social_script_dummy, web_script = video_engine.generate_dual_scripts(cleaned_text, config)
-            
-            if not web_script:
-                logger.error(f"[{filename}] Failed to generate scripts. Skipping.")
-                continue
+        # Parse
+        logger.info(f"[{filename}] Cleaning HTML content...")
+        cleaned_text, vocab_list, lesson_title = video_engine.clean_html_content(raw_html)
+        
+        logger.info(f"[{filename}] Generating scripts (Web & Social)...")
+        social_script_dummy, web_script = video_engine.generate_dual_scripts(cleaned_text, config)
+        
+        if not web_script:
+            logger.error(f"[{filename}] Failed to generate scripts. Skipping.")
+            return
 
-            # --- Generate WEB Video ---
-            logger.info(f"[{filename}] Generating Web Video...")
-            
-            # 1. Roster
-            web_roster = video_engine.get_active_roster(web_script, config)
-            
-            # 2. Audio
-            web_frames_dir = os.path.join("output", "frames_web")
-            web_audio_dir = os.path.join("output", "audio_web")
-            
-            script_web = copy.deepcopy(web_script)
-            script_web = video_engine.generate_audio(
-                script_web, config, 
-                output_dir=web_audio_dir
-            )
+        # --- Generate WEB Video ---
+        logger.info(f"[{filename}] Generating Web Video...")
+        
+        # 1. Roster
+        web_roster = video_engine.get_active_roster(web_script, config)
+        
+        # 2. Audio
+        # generate_audio only adds keys to each line, so per-line dict copies are enough
+        script_web = [dict(line) for line in web_script]
+        script_web = video_engine.generate_audio(script_web, config)
+        
+        # 3. Frames + Story (frames are piped straight into the encoder)
+        web_story_path = video_engine.assemble_video(
+            script_web, web_roster,
+            output_dir=work_dir,
+            output_filename=f"temp_web_story_{lesson_id}.mp4",
+            config=config
+        )
+        
+        if web_story_path:
+            final_web_clips = []
             
-            # 3. Frames
-            video_engine.generate_frames(
-                script_web, web_roster, config,
-                output_dir=web_frames_dir
+            # Title Card
+            title_card_img = video_engine.create_title_card(lesson_title, config)
+            title_card_path = video_engine.encode_still_segment(
+                title_card_img,
+                os.path.join(work_dir, "temp", f"title_card_{lesson_id}.mp4"),
+                duration=3.0,
+                config=config
             )
+            if title_card_path: final_web_clips.append(title_card_path)
             
-            # 4. Assemble Story
-            web_story_path = video_engine.assemble_video(
-                script_web,
-                output_dir="output",
-                output_filename=f"temp_web_story_{lesson_id}.mp4"
-            )
+            final_web_clips.append(web_story_path)
             
-            if web_story_path:
-                final_web_clips = []
-                
-                # Title Card
-                title_card_path = video_engine.create_title_card(lesson_title, config)
-                if os.path.exists(title_card_path):
-                    final_web_clips.append(ImageClip(title_card_path).with_duration(3.0))
-                
-                final_web_clips.append(VideoFileClip(web_story_path))
-                
-                final_web = concatenate_videoclips(final_web_clips)
-                
-                web_output_path = os.path.abspath(os.path.join(output_dir, f"{lesson_id}_web.mp4"))
-                final_web.write_videofile(web_output_path, codec="libx264", audio_codec="aac", logger=None)
+            # Stream copy: title card segment shares the story's encoding
+            web_output_path = os.path.abspath(os.path.join(output_dir, f"{lesson_id}_web.mp4"))
+            if video_engine.concat_videos(final_web_clips, web_output_path, config):
                 logger.info(f"[{filename}] Web Video exported: {web_output_path}")
-                
-                # Cleanup Web Clips
-                try:
-                    final_web.close()
-                    for clip in final_web_clips:
-                        clip.close()
-                except Exception as e:
-                    logger.warning(f"Error closing web clips: {e}")
-                    
             else:
-                logger.error(f"[{filename}] Failed to assemble Web Video story.")
-
-            # --- Generate SOCIAL Video (Teaser) ---
-            logger.info(f"[{filename}] Generating Social Teaser...")
-            
-            # Slice: Take first 6 lines
-            script_social = copy.deepcopy(web_script[:6]) # Use web_script source to respect dual_script output structure
-            
-            # Recalculate roster for the slice
-            social_roster = video_engine.get_active_roster(script_social, config)
-            
-            # Generate Audio for Social (Wait, we can reuse if identical, but distinct output dirs is safer)
-            # Actually, reusing 'web_script' audio might fail if we slice BEFORE generating audio. 
-            # In Web Video step, we generated audio for FULL script.
-            # So script_social (which is web_script[:6]) should ALREADY have audio_file keys if we used the populated list.
-            # BUT, I used `script_web = copy.deepcopy(web_script)` then generated audio into `script_web`.
-            # `web_script` variable itself is still the raw JSON without audio paths.
-            # So I need to generate audio for social specifically.
-            
-            social_audio_dir = os.path.join("output", "audio_social")
-            script_social = video_engine.generate_audio(
-                script_social, config,
-                output_dir=social_audio_dir
-            )
-            
-            # 1. Listening Part (Masked)
-            listening_script = copy.deepcopy(script_social)
-            for line in listening_script:
-                if 'text' in line: line['text'] = "..... ? ....."
+                logger.error(f"[{filename}] Failed to export Web Video.")
                 
-            video_engine.generate_frames(
-                listening_script, social_roster, config,
-                output_dir=os.path.join("output", "frames_listening")
-            )
-            
-            listening_video_path = video_engine.assemble_video(
-                listening_script,
-                output_dir="output",
-                output_filename=f"listening_part_{lesson_id}.mp4"
-            )
-            
-            # 2. Reading Part (Normal)
-            video_engine.generate_frames(
-                script_social, social_roster, config,
-                output_dir=os.path.join("output", "frames_reading")
+        else:
+            logger.error(f"[{filename}] Failed to assemble Web Video story.")
+
+        # --- Generate SOCIAL Video (Teaser) ---
+        logger.info(f"[{filename}] Generating Social Teaser...")
+        
+        # Slice: Take first 6 lines. They already carry their audio from the Web step.
+        script_social = [dict(line) for line in script_web[:6]]
+        
+        # Recalculate roster for the slice
+        social_roster = video_engine.get_active_roster(script_social, config)
+        
+        # 1. Listening (Masked) + Reading (Normal) Parts: same audio, two independent encodes in parallel
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            listening_future = executor.submit(
+                video_engine.assemble_video,
+                script_social, social_roster,
+                output_dir=work_dir,
+                output_filename=f"listening_part_{lesson_id}.mp4",
+                config=config,
+                masked_text=video_engine.MASKED_TEXT
             )
-            
-            reading_video_path = video_engine.assemble_video(
-                script_social,
-                output_dir="output",
-                output_filename=f"reading_part_{lesson_id}.mp4"
+            reading_future = executor.submit(
+                video_engine.assemble_video,
+                script_social, social_roster,
+                output_dir=work_dir,
+                output_filename=f"reading_part_{lesson_id}.mp4",
+                config=config
             )
+        listening_video_path = listening_future.result()
+        reading_video_path = reading_future.result()
+        
+        # 2. Assemble Social Video
+        temp_dir = os.path.join(work_dir, "temp")
+        final_social_clips = []
+        
+        # Intro (last 0.3s trimmed)
+        if shared_clips.get("intro"):
+            final_social_clips.append({"path": shared_clips["intro"], "trim_end": 0.3})
             
-            # 3. Assemble Social Video
-            final_social_clips = []
+        # Listening
+        if listening_video_path and os.path.exists(listening_video_path):
+            final_social_clips.append({"path": listening_video_path})
             
-            # Intro
-            if os.path.exists("assets/intro.mp4"):
-                intro = VideoFileClip("assets/intro.mp4").resized(new_size=(1080, 1920))
-                if intro.duration > 1:
-                    intro = intro.subclipped(0, intro.duration - 0.3)
-                final_social_clips.append(intro)
-                
-            # Listening
-            if listening_video_path and os.path.exists(listening_video_path):
-                final_social_clips.append(VideoFileClip(listening_video_path))
-                
-            # Separator
-            sep_clip = video_engine.create_separator_clip(config, "output")
-            if sep_clip: final_social_clips.append(sep_clip)
-            
-            # Reading
-            if reading_video_path and os.path.exists(reading_video_path):
-                final_social_clips.append(VideoFileClip(reading_video_path))
-                
-            # Vocab
-            if vocab_list:
-                vocab_assets = generate_vocab_assets(vocab_list)
-                if vocab_assets:
-                    vocab_clip = create_vocab_video_sequence(vocab_assets)
-                    if vocab_clip: final_social_clips.append(vocab_clip)
+        # Separator
+        if shared_clips.get("separator"):
+            final_social_clips.append({"path": shared_clips["separator"]})
+        
+        # Reading
+        if reading_video_path and os.path.exists(reading_video_path):
+            final_social_clips.append({"path": reading_video_path})
             
-            if final_social_clips:
-                final_social = concatenate_videoclips(final_social_clips)
-                
-                # Branding
-                if os.path.exists("assets/NoBackground.png"):
-                    overlay = ImageClip("assets/NoBackground.png")\
-                        .with_duration(final_social.duration)\
-                        .with_position(('center', 'bottom'))
-                    final_social = CompositeVideoClip([final_social, overlay])
-                    
-                # Music (Check config/args, defaulting to None for batch as simplistic approach, or check config)
-                # App sets config["ENABLE_MUSIC"] based on UI. 
-                # Let's assume False for batch unless config has it.
-                if config.get("ENABLE_MUSIC"):
-                    final_social = video_engine.add_background_music(final_social, "assets")
+        # Vocab
+        if vocab_list:
+            vocab_assets = generate_vocab_assets(vocab_list, temp_dir=vocab_temp_dir)
+            if vocab_assets:
+                vocab_path = create_vocab_video_sequence(vocab_assets, os.path.join(temp_dir, f"vocab_{lesson_id}.mp4"), config)
+                if vocab_path: final_social_clips.append({"path": vocab_path})
+        
+        if final_social_clips:
+            # Music (Check config/args, defaulting to None for batch as simplistic approach, or check config)
+            # App sets config["ENABLE_MUSIC"] based on UI. 
+            # Let's assume False for batch unless config has it.
+            music_path = video_engine.pick_background_music("assets") if config.get("ENABLE_MUSIC") else None
 
-                # Social Title Overlay
-                title_social_path = video_engine.create_social_title_img(lesson_title, config)
-                if os.path.exists(title_social_path):
-                    title_overlay = ImageClip(title_social_path).with_duration(1.0).with_start(0)
-                    final_social = CompositeVideoClip([final_social, title_overlay])
-                    
-                social_output_path = os.path.abspath(os.path.join(output_dir, f"{lesson_id}.mp4"))
-                final_social.write_videofile(social_output_path, codec="libx264", audio_codec="aac", logger=None)
+            # Social Title Overlay
+            title_social_img = video_engine.create_social_title_img(lesson_title, config)
+                
+            # Concat + Branding + Title + Music in a single ffmpeg pass
+            social_output_path = os.path.abspath(os.path.join(output_dir, f"{lesson_id}.mp4"))
+            if video_engine.compose_video(
+                final_social_clips,
+                social_output_path,
+                config,
+                overlay_path="assets/NoBackground.png",
+                title_overlay=title_social_img,
+                music_path=music_path
+            ):
                 logger.info(f"[{filename}] Social Video exported: {social_output_path}")
+            else:
+                logger.error(f"[{filename}] Failed to export Social Video.")
+        
+        logger.info(f"[{filename}] Done.")
+        
+    except Exception as e:
+        logger.error(f"[{filename}] Error processing file: {e}", exc_info=True)
+        
+    finally:
+        # Cleanup per file: final videos live in output_dir, everything under work_dir is intermediate
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-                # Cleanup Social Clips
-                try:
-                    final_social.close()
-                    # Also close the sub-clips in the list
-                    for clip in final_social_clips:
-                        clip.close()
-                    # Explicitly close overlay if it exists (it's in the composite, but good to be sure)
-                    if 'overlay' in locals(): overlay.close()
-                    if 'title_overlay' in locals(): title_overlay.close()
-                except Exception as e:
-                    logger.warning(f"Error closing social clips: {e}")
-            
-            logger.info(f"[{filename}] Done.")
-            
-        except Exception as e:
-            logger.error(f"[{filename}] Error processing file: {e}", exc_info=True)
-            
-        finally:
-            # Cleanup per file
-            video_engine.cleanup_workspace()
+def main():
+    # 1. Setup
+    logger.info("Starting Batch Generator...")
+    config = video_engine.load_config()
+    
+    input_dir = "./input_lessons"
+    output_dir = "./output"
+    
+    os.makedirs(input_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # 2. File Loop
+    files = glob.glob(os.path.join(input_dir, "*.txt"))
+    if not files:
+        logger.warning(f"No .txt files found in {input_dir}. Please add some lesson files.")
+        return
+
+    # Lessons are independent; leave half the cores for the ffmpeg encoders.
+    max_workers = max(1, (os.cpu_count() or 2) // 2)
+    logger.info(f"Found {len(files)} files to process ({max_workers} workers).")
+    
+    # tts_max_workers caps TTS requests for the whole run: split it across the lesson processes
+    settings = config.setdefault('settings', {})
+    tts_workers = settings.get('tts_max_workers', 8)
+    settings['tts_max_workers'] = max(1, tts_workers // min(max_workers, len(files)))
+    
+    shared_clips = prepare_shared_clips(config, output_dir)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_lesson, file_path, config, output_dir, shared_clips): file_path for file_path in files}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"[{os.path.basename(futures[future])}] Worker failed: {e}", exc_info=True)
+    
+    # Shared clips are only inputs; the intro stays in the asset cache
+    shutil.rmtree(os.path.join(output_dir, "shared"), ignore_errors=True)
+    shutil.rmtree(os.path.join(output_dir, "work"), ignore_errors=True)
 
 if __name__ == "__main__":
     main()
@@ -4,20 +4,24 @@ import logging
 import re
 import random
 import shutil
-import time
 import textwrap
-import copy
-from typing import Optional, List, Dict, Any, Tuple, Callable
+import functools
+import hashlib
+import subprocess
+import uuid
+import io
+import queue
+import threading
+import wave
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, List, Dict, Any, Tuple, Callable, Union, Iterator
 
 from dotenv import load_dotenv
-import google.generativeai as genai
-from google.cloud import texttospeech
-from mutagen.mp3 import MP3
-from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageEnhance
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 from bs4 import BeautifulSoup
 import ffmpeg
-from moviepy import ImageClip, CompositeVideoClip, AudioFileClip, CompositeAudioClip
-from moviepy.audio.fx import AudioLoop, AudioFadeOut
+import numpy as np
 
 # Load environment variables
 load_dotenv()
@@ -56,6 +60,82 @@ def setup_logging(debug_mode: bool = False):
 
 logger = logging.getLogger(__name__)
 
+# Balloon text for the "Blind Listening" part of the Social video
+MASKED_TEXT = "..... ? ....."
+
+# Output format shared by every generated video
+VIDEO_SIZE = (1080, 1920)
+VIDEO_FPS = 25
+AUDIO_SAMPLE_RATE = 44100
+
+# Encoding for script/still segments; identical settings let them be stream-copied together.
+# The video encoder itself comes from get_segment_output_kwargs.
+SEGMENT_OUTPUT_KWARGS = {
+    'acodec': 'aac',
+    'pix_fmt': 'yuv420p',
+    'r': VIDEO_FPS,
+    'ar': AUDIO_SAMPLE_RATE,
+    'ac': 2
+}
+
+# Rendered frames buffered between render_frames and the ffmpeg pipe (~6 MB each)
+FRAME_QUEUE_SIZE = 4
+
+# Finished frames kept by render_frames for repeated (speaker, text) pairs
+FRAME_CACHE_SIZE = 8
+
+# Quality/speed tuning per H.264 encoder (settings.video_codec)
+VIDEO_ENCODER_PARAMS = {
+    'h264_nvenc': {'preset': 'p4', 'tune': 'hq', 'rc': 'vbr', 'cq': 23, 'b:v': 0},
+    'h264_qsv': {'preset': 'medium', 'global_quality': 23},
+    'h264_videotoolbox': {'b:v': '6M'},
+    'libx264': {'preset': 'medium', 'crf': 23}
+}
+
+# Hardware encoders tried, in order, when settings.video_codec is "auto"
+HW_ENCODER_PREFERENCE = ['h264_nvenc', 'h264_videotoolbox', 'h264_qsv']
+
+# TTS is requested as raw 16-bit mono PCM at this rate and piped straight into ffmpeg
+TTS_SAMPLE_RATE = 24000
+
+# Pre-processed copies of assets, kept across runs
+ASSET_CACHE_DIR = os.path.join("assets", ".cache")
+
+# Synthesized lines are kept across runs (not removed by cleanup_workspace),
+# trimmed least-recently-used first once the directory passes this size
+TTS_CACHE_DIR = os.path.join("output", "tts_cache")
+TTS_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# HTML cleaning patterns, compiled once instead of on every lesson
+WHITESPACE_RE = re.compile(r'\s+')
+TRANSLATE_PREFIX_RE = re.compile(r'^Translate:?\s*', re.IGNORECASE)
+EXAMPLE_PREFIX_RE = re.compile(r'^Example:?\s*', re.IGNORECASE)
+BR_TAG_RE = re.compile(r'<br\s*/?>', re.IGNORECASE)
+TOOLTIP_RE = re.compile(r'\[tooltip\].*?\[/tooltip\]', re.DOTALL)
+ESEMPIO_TAG_RE = re.compile(r'\[/?esempio\]')
+
+# Balloon text wrapping (stateless, safe to share across threads)
+BALLOON_WRAPPER = textwrap.TextWrapper(width=30)
+
+# Gemini JSON mode: the Web script response must match this shape
+WEB_SCRIPT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "web_script": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "speaker": {"type": "STRING"},
+                    "text": {"type": "STRING"}
+                },
+                "required": ["speaker", "text"]
+            }
+        }
+    },
+    "required": ["web_script"]
+}
+
 # Load configuration
 def load_config(config_path: str = 'config.json') -> Dict[str, Any]:
     try:
@@ -77,36 +157,45 @@ def format_time(seconds: float) -> str:
         return f"{m}m {s}s"
     return f"{s}s"
 
-def resolve_character_key(name: str, config: Dict[str, Any]) -> Optional[str]:
+@functools.lru_cache(maxsize=1024)
+def match_character_key(name: str, valid_keys: Tuple[str, ...]) -> Optional[str]:
     """
-    Robustly resolves a character name from the script to a key in config.json.
+    Helper for resolve_character_key, memoized per (name, character keys):
+    the same few speakers are resolved for every line of every script.
     """
-    if not name or name == "Narrator":
-        return None
-
-    valid_keys = config.get('characters', {}).keys()
-    
     # Strategy 1: Exact Match
     if name in valid_keys:
         return name
+    
+    name_lower = name.lower()
+    lowered_keys = [(key, key.lower()) for key in valid_keys]
         
     # Strategy 2: Case-Insensitive
-    for key in valid_keys:
-        if key.lower() == name.lower():
+    for key, key_lower in lowered_keys:
+        if key_lower == name_lower:
             return key
             
     # Strategy 3: Partial Match (Name starts with Key)
-    for key in valid_keys:
-        if name.lower().startswith(key.lower()):
+    for key, key_lower in lowered_keys:
+        if name_lower.startswith(key_lower):
             return key
             
     # Strategy 4: Reverse Partial (Key starts with Name)
-    for key in valid_keys:
-        if key.lower().startswith(name.lower()):
+    for key, key_lower in lowered_keys:
+        if key_lower.startswith(name_lower):
             return key
             
     return None
 
+def resolve_character_key(name: str, config: Dict[str, Any]) -> Optional[str]:
+    """
+    Robustly resolves a character name from the script to a key in config.json.
+    """
+    if not name or name == "Narrator":
+        return None
+
+    return match_character_key(name, tuple(config.get('characters', {}).keys()))
+
 def get_active_roster(parsed_script: List[Dict[str, Any]], config: Dict[str, Any]) -> List[str]:
     """
     Extracts unique char names (excluding Narrator) to determine who is on stage.
@@ -139,16 +228,16 @@ def extract_vocabulary(soup: BeautifulSoup) -> List[Dict[str, str]]:
         translation = ""
         if trans_elem:
             raw_trans = trans_elem.get_text(separator=' ', strip=True)
-            translation = re.sub(r'^Translate:?\s*', '', raw_trans, flags=re.IGNORECASE)
-            translation = re.sub(r'\s+', ' ', translation).strip()
+            translation = TRANSLATE_PREFIX_RE.sub('', raw_trans)
+            translation = WHITESPACE_RE.sub(' ', translation).strip()
             
         # 3. Example
         ex_elem = card.find('div', class_='vocab-card-example')
         example = ""
         if ex_elem:
             raw_ex = ex_elem.get_text(separator=' ', strip=True)
-            example = re.sub(r'^Example:?\s*', '', raw_ex, flags=re.IGNORECASE)
-            example = re.sub(r'\s+', ' ', example).strip()
+            example = EXAMPLE_PREFIX_RE.sub('', raw_ex)
+            example = WHITESPACE_RE.sub(' ', example).strip()
             
         if word:
             vocab_list.append({
@@ -187,20 +276,20 @@ def clean_html_content(raw_html: str) -> Tuple[str, List[Dict[str, str]], str]:
 
     # Step B: Cleaning
     # 1. Newlines: <br> -> \n
-    text = re.sub(r'<br\s*/?>', '\n', text, flags=re.IGNORECASE)
+    text = BR_TAG_RE.sub('\n', text)
     
     # 2. Remove Italian Translations: [tooltip]...[/tooltip]
-    text = re.sub(r'\[tooltip\].*?\[/tooltip\]', ' ', text, flags=re.DOTALL)
+    text = TOOLTIP_RE.sub(' ', text)
     
     # 3. Remove Custom Tags: [esempio] and [/esempio]
-    text = re.sub(r'\[/?esempio\]', ' ', text)
+    text = ESEMPIO_TAG_RE.sub(' ', text)
     
     # 4. Strip HTML tags
     temp_soup = BeautifulSoup(text, 'html.parser')
     final_text = temp_soup.get_text(separator=' ')
     
     # Clean up excessive whitespace
-    final_text = re.sub(r'\s+', ' ', final_text).strip()
+    final_text = WHITESPACE_RE.sub(' ', final_text).strip()
     
     return final_text, vocab_list, lesson_title
 
@@ -220,6 +309,8 @@ def generate_dual_scripts(raw_text: str, config: Dict[str, Any]) -> Tuple[List[D
     web_script = []
 
     try:
+        # Deferred: the Google SDKs are heavy and only needed once a script/audio is requested
+        import google.generativeai as genai
         genai.configure(api_key=api_key)
         model = genai.GenerativeModel(config.get('gemini_model', 'gemini-pro'))
 
@@ -238,14 +329,16 @@ def generate_dual_scripts(raw_text: str, config: Dict[str, Any]) -> Tuple[List[D
         """
         
         full_web_prompt = f"{web_prompt}\n\nRAW TEXT:\n{raw_text}"
-        response_web = model.generate_content(full_web_prompt)
+        # JSON mode: the response is bare JSON matching the schema, no markdown fences
+        response_web = model.generate_content(
+            full_web_prompt,
+            generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": WEB_SCRIPT_SCHEMA
+            }
+        )
         text_web = response_web.text
         
-        # Cleanup
-        if text_web.startswith("```json"): text_web = text_web[7:]
-        if text_web.startswith("```"): text_web = text_web[3:]
-        if text_web.endswith("```"): text_web = text_web[:-3]
-        
         try:
              web_json = json.loads(text_web)
              web_script = web_json.get("web_script", [])
@@ -261,23 +354,124 @@ def generate_dual_scripts(raw_text: str, config: Dict[str, Any]) -> Tuple[List[D
         logger.error(f"Error generating dual scripts: {e}", exc_info=True)
         return [], []
 
-def generate_single_audio(text: str, speaker: str, index: int, config: Dict[str, Any], output_dir: str = "output") -> Tuple[Optional[str], float]:
+def get_tts_cache_key(text: str, voice_params: Dict[str, Any]) -> str:
     """
-    Step 2a: Generate Audio
-    - Uses Google Cloud TTS
-    - Returns filename and duration
+    Content address for a synthesized line: sha256 of text + voice params + encoding.
     """
-    os.makedirs(output_dir, exist_ok=True)
+    payload = json.dumps({"text": text, "voice": voice_params, "encoding": f"LINEAR16_{TTS_SAMPLE_RATE}"}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-    if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-        # Log warning if needed, but assuming env is set
+def get_pcm_duration(pcm: bytes) -> float:
+    """
+    Helper: Duration in seconds of 16-bit mono PCM at TTS_SAMPLE_RATE.
+    """
+    return len(pcm) / (2 * TTS_SAMPLE_RATE)
+
+def touch_cache_entry(path: str) -> None:
+    """
+    Helper: Marks a TTS cache entry as recently used (mtime drives trim_tts_cache).
+    """
+    try:
+        os.utime(path)
+    except OSError:
         pass
 
+def trim_tts_cache(max_bytes: int = TTS_CACHE_MAX_BYTES, cache_dir: str = TTS_CACHE_DIR) -> None:
+    """
+    Evicts the least recently used TTS cache entries (Google .pcm and edge-tts
+    .mp3 alike, oldest mtime first) until the directory fits in max_bytes.
+    """
+    entries = []
     try:
-        client = texttospeech.TextToSpeechClient()
-    except Exception as e:
-        logger.error(f"Failed to initialize TTS client: {e}", exc_info=True)
-        return None, 0.0
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                # In-flight atomic writes are left alone
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return
+    
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return
+    
+    entries.sort()
+    removed = 0
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass  # Another worker trimmed it first
+        except OSError as e:
+            logger.warning(f"Could not evict TTS cache entry {path}: {e}")
+            continue
+        total -= size
+    logger.info(f"Trimmed {removed} TTS cache entries ({total / 1024 / 1024:.1f} MB left).")
+
+def pcm_to_wav(pcm: bytes) -> bytes:
+    """
+    Helper: Wraps TTS PCM in a WAV header (for playback widgets).
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(TTS_SAMPLE_RATE)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+@functools.lru_cache(maxsize=32)
+def get_font(font_path: str, size: int) -> ImageFont.FreeTypeFont:
+    """
+    ImageFont.truetype, loaded once per (path, size). Raises like truetype
+    (OSError) if the font can't be opened; failures are not cached.
+    """
+    return ImageFont.truetype(font_path, size)
+
+@functools.lru_cache(maxsize=None)
+def get_tts_client():
+    """
+    Process-wide TTS client, created on first use. The gRPC channel is
+    thread-safe, so every line (and every run) shares it instead of paying
+    a new connection handshake per call.
+    """
+    from google.cloud import texttospeech
+    return texttospeech.TextToSpeechClient()
+
+def synthesize_streaming(client, text: str, voice) -> bytes:
+    """
+    Helper: StreamingSynthesize call (Chirp 3 HD voices only). The first chunk
+    arrives well before a batch synthesize_speech response would; the raw PCM
+    chunks are joined into one buffer.
+    """
+    from google.cloud import texttospeech
+    
+    streaming_config = texttospeech.StreamingSynthesizeConfig(
+        voice=voice,
+        streaming_audio_config=texttospeech.StreamingAudioConfig(
+            audio_encoding=texttospeech.AudioEncoding.PCM,
+            sample_rate_hertz=TTS_SAMPLE_RATE
+        )
+    )
+    requests = iter([
+        texttospeech.StreamingSynthesizeRequest(streaming_config=streaming_config),
+        texttospeech.StreamingSynthesizeRequest(input=texttospeech.StreamingSynthesisInput(text=text))
+    ])
+    return b"".join(response.audio_content for response in client.streaming_synthesize(requests))
+
+def generate_single_audio(text: str, speaker: str, index: int, config: Dict[str, Any]) -> Tuple[Optional[bytes], float]:
+    """
+    Step 2a: Generate Audio
+    - Uses Google Cloud TTS (LINEAR16)
+    - Returns raw PCM bytes and duration
+    """
+    if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
+        # Log warning if needed, but assuming env is set
+        pass
 
     # Determine Voice Params
     voice_params = None
@@ -297,6 +491,24 @@ def generate_single_audio(text: str, speaker: str, index: int, config: Dict[str,
          logger.critical(f"No voice params found for {speaker} and no default narrator config.")
          return None, 0.0
 
+    # Cache Lookup: identical text + voice always synthesizes the same audio
+    cache_key = get_tts_cache_key(text, voice_params)
+    cache_path = os.path.join(TTS_CACHE_DIR, f"{cache_key}.pcm")
+    if os.path.exists(cache_path):
+        logger.debug(f"TTS cache hit for line {index} ({speaker})")
+        with open(cache_path, "rb") as f:
+            pcm = f.read()
+        touch_cache_entry(cache_path)
+        return pcm, get_pcm_duration(pcm)
+
+    from google.cloud import texttospeech
+    
+    try:
+        client = get_tts_client()
+    except Exception as e:
+        logger.error(f"Failed to initialize TTS client: {e}", exc_info=True)
+        return None, 0.0
+
     # Prepare Request
     synthesis_input = texttospeech.SynthesisInput(text=text)
     
@@ -315,82 +527,102 @@ def generate_single_audio(text: str, speaker: str, index: int, config: Dict[str,
     )
 
     audio_config = texttospeech.AudioConfig(
-        audio_encoding=texttospeech.AudioEncoding.MP3
+        audio_encoding=texttospeech.AudioEncoding.LINEAR16,
+        sample_rate_hertz=TTS_SAMPLE_RATE
     )
 
     try:
-        response = client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
-        )
+        if config.get('settings', {}).get('tts_streaming', False):
+            pcm = synthesize_streaming(client, text, voice)
+        else:
+            response = client.synthesize_speech(
+                input=synthesis_input, voice=voice, audio_config=audio_config
+            )
+            # LINEAR16 comes wrapped in a WAV header; keep only the samples
+            with wave.open(io.BytesIO(response.audio_content), "rb") as wav:
+                pcm = wav.readframes(wav.getnframes())
     except Exception as e:
         logger.error(f"TTS API Error for {speaker}: {e}", exc_info=True)
         return None, 0.0
-
-    filename = f"audio_{index}.mp3"
-    filepath = os.path.join(output_dir, filename)
-    filepath = os.path.abspath(filepath) 
-
-    with open(filepath, "wb") as out:
-        out.write(response.audio_content)
         
+    # Populate the cache atomically; another worker may be writing the same key.
     try:
-        audio = MP3(filepath)
-        duration = audio.info.length
+        os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as out:
+            out.write(pcm)
+        os.replace(tmp_path, cache_path)
     except Exception as e:
-        logger.warning(f"Could not determine duration for {filepath}: {e}")
-        duration = 0.0
+        logger.warning(f"Could not write TTS cache entry {cache_path}: {e}")
         
-    return filepath, duration
+    return pcm, get_pcm_duration(pcm)
 
-def generate_audio(parsed_script: List[Dict[str, Any]], config: Dict[str, Any], output_dir: str = "output", progress_callback: Optional[Callable[[float], None]] = None) -> List[Dict[str, Any]]:
+def generate_audio(parsed_script: List[Dict[str, Any]], config: Dict[str, Any], progress_callback: Optional[Callable[[float], None]] = None) -> List[Dict[str, Any]]:
     """
     2. Audio Generation Logic
     Generates TTS audio for each line using Google Cloud TTS.
+    The PCM is kept in memory on the line ('audio_pcm') for assemble_video.
     """
     logger.info("Initializing TTS Client...")
     
-    updated_script = []
-    total_lines = len(parsed_script)
+    updated_script = list(parsed_script)
     
-    for i, line in enumerate(parsed_script):
-        speaker = line.get('speaker')
-        text = line.get('text')
-        
-        if not speaker or not text:
-            updated_script.append(line)
-            continue
+    # Each line is an independent network round-trip, so fire them concurrently.
+    # Keep the pool below the per-project TTS quota.
+    max_workers = config.get('settings', {}).get('tts_max_workers', 8)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Repeated lines (same speaker, same text) share one request; they would
+        # all miss the disk cache if submitted side by side.
+        requests = {}
+        indices = {}
+        for i, line in enumerate(parsed_script):
+            speaker = line.get('speaker')
+            text = line.get('text')
             
-        filepath, duration = generate_single_audio(text, speaker, i, config, output_dir=output_dir)
-        
-        if filepath:
-            line['audio_file'] = filepath
-            line['audio_path'] = filepath
-            line['duration'] = duration
-        
-        updated_script.append(line)
+            if not speaker or not text:
+                continue
+            
+            if (speaker, text) not in requests:
+                future = executor.submit(generate_single_audio, text, speaker, i, config)
+                requests[(speaker, text)] = future
+                indices[future] = []
+            indices[requests[(speaker, text)]].append(i)
         
-        if progress_callback:
-            progress_callback((i + 1) / total_lines)
+        # Results go back by index, so completion order doesn't matter;
+        # progress counts finished requests rather than waiting on the slowest one.
+        for done, future in enumerate(as_completed(indices), start=1):
+            pcm, duration = future.result()
+            
+            if pcm:
+                for i in indices[future]:
+                    updated_script[i]['audio_pcm'] = pcm
+                    updated_script[i]['duration'] = duration
             
+            if progress_callback:
+                progress_callback(done / len(indices))
+    
+    # Once per batch rather than per write: one directory scan for the whole script
+    trim_tts_cache()
     return updated_script
 
-def generate_frames(parsed_script: List[Dict[str, Any]], roster: List[str], config: Dict[str, Any], output_dir: str = "output", progress_callback: Optional[Callable[[float], None]] = None) -> List[Dict[str, Any]]:
+def render_frames(parsed_script: List[Dict[str, Any]], roster: List[str], config: Dict[str, Any], masked_text: Optional[str] = None) -> Iterator[Image.Image]:
     """
     3. Visual Generation Logic (Vertical Ensemble)
+    Yields one RGB frame per line, in script order. Frames are never written to
+    disk: assemble_video pipes them straight into ffmpeg.
+    If masked_text is set, the balloon shows it instead of the line text.
     """
     logger.info("Starting visual generation...")
     
-    os.makedirs(output_dir, exist_ok=True)
-    
-    video_width = 1080
-    video_height = 1920
+    video_width, video_height = VIDEO_SIZE
     settings = config.get('settings', {})
     bg_color = settings.get('background_color', '#FFFFFF')
     
     # Load Font
     font_path = settings.get('font_path', 'arial.ttf')
     try:
-        font = ImageFont.truetype(font_path, settings.get('font_size', 50))
+        font = get_font(font_path, settings.get('font_size', 50))
     except IOError:
         logger.warning(f"Could not load font {font_path}, using default.")
         font = ImageFont.load_default()
@@ -405,10 +637,13 @@ def generate_frames(parsed_script: List[Dict[str, Any]], roster: List[str], conf
         balloon_img = balloon_img.resize((b_target_width, b_target_height), Image.Resampling.LANCZOS)
     except FileNotFoundError:
         logger.error(f"Balloon image not found at {balloon_path}")
-        return parsed_script
+        return
 
     # Pre-load and Normalize Roster Images
     target_char_height = 900
+    num_chars = len(roster)
+    slot_width = video_width // num_chars if num_chars else video_width
+    max_char_width = int(slot_width * 0.95)
     roster_images = {}
     
     for char_name in roster:
@@ -419,7 +654,13 @@ def generate_frames(parsed_script: List[Dict[str, Any]], roster: List[str], conf
                 img = Image.open(img_path).convert("RGBA")
                 width_percent = (target_char_height / float(img.size[1]))
                 new_width = int((float(img.size[0]) * float(width_percent)))
-                img = img.resize((new_width, target_char_height), Image.Resampling.LANCZOS)
+                new_height = target_char_height
+                # Fit to the slot in the same pass instead of resampling twice
+                if new_width > max_char_width:
+                    new_height = int(new_height * (max_char_width / float(new_width)))
+                    new_width = max_char_width
+                # reducing_gap: cheap integer downscale first, LANCZOS for the rest
+                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
                 roster_images[char_name] = img
             except Exception as e:
                 logger.warning(f"Could not load image for {char_name}: {e}")
@@ -428,71 +669,75 @@ def generate_frames(parsed_script: List[Dict[str, Any]], roster: List[str], conf
 
     if not roster_images:
         logger.error("No character images loaded! Check assets.")
-        # Proceeding might be dangerous, but caller handles return
-        return parsed_script
-
-    total_lines = len(parsed_script)
+        # Nothing to render; the caller sees an empty sequence
+        return
 
     # Layout Calculation
     BUFFER_SPACE = 50
     total_stack_height = balloon_img.height + BUFFER_SPACE + target_char_height
     balloon_y = (video_height - total_stack_height) // 2
     char_y_top = balloon_y + balloon_img.height + BUFFER_SPACE
+    balloon_x = (video_width - balloon_img.width) // 2
+    balloon_center_x = video_width // 2
+    balloon_center_y = balloon_y + (balloon_img.height // 2)
 
-    for i, line in enumerate(parsed_script):
+    # Build each sprite's dimmed variant once, not per line
+    sprites = {}
+    
+    for char_name, char_img in roster_images.items():
+        dimmed_img = char_img.copy()
+        dimmed_img.putalpha(dimmed_img.split()[3].point(lambda p: p * 0.5))
+        sprites[char_name] = (char_img, dimmed_img)
+
+    # The stage (characters + empty balloon) only depends on who is speaking,
+    # so it is composited once per active speaker and reused.
+    stages = {}
+
+    # Identical (speaker, text) frames are reused: every Blind Listening line
+    # shows the same masked text, so that video only needs one frame per speaker.
+    frame_cache = OrderedDict()
+
+    for line in parsed_script:
         speaker = line.get('speaker')
-        text_content = line.get('text', "")
+        text_content = masked_text if masked_text is not None else line.get('text', "")
+        
+        # Narrator lines dim everyone
+        active_key = None if speaker == "Narrator" else resolve_character_key(speaker, config)
         
-        frame = Image.new('RGBA', (video_width, video_height), bg_color)
+        cached_frame = frame_cache.get((active_key, text_content))
+        if cached_frame is not None:
+            frame_cache.move_to_end((active_key, text_content))
+            yield cached_frame
+            continue
         
-        # --- Stage Layer ---
-        num_chars = len(roster)
-        if num_chars > 0:
-            slot_width = video_width // num_chars
-            max_char_width = int(slot_width * 0.95)
+        stage = stages.get(active_key)
+        if stage is None:
+            stage = Image.new('RGB', (video_width, video_height), bg_color)
             
+            # --- Stage Layer ---
             for idx, char_name in enumerate(roster):
-                if char_name not in roster_images:
+                if char_name not in sprites:
                     continue
                 
-                char_img = roster_images[char_name].copy()
-                
-                if char_img.width > max_char_width:
-                     ratio = max_char_width / float(char_img.width)
-                     new_h = int(char_img.height * ratio)
-                     char_img = char_img.resize((max_char_width, new_h), Image.Resampling.LANCZOS)
-
-                current_speaker_key = resolve_character_key(speaker, config)
-                is_active = (current_speaker_key == char_name)
-                is_narrator = (speaker == "Narrator")
-                
-                if is_narrator or not is_active:
-                     alpha = char_img.split()[3]
-                     alpha = alpha.point(lambda p: p * 0.5)
-                     char_img.putalpha(alpha)
+                active_img, dimmed_img = sprites[char_name]
+                char_img = active_img if char_name == active_key else dimmed_img
                 
                 slot_center_x = (idx * slot_width) + (slot_width // 2)
-                img_w, img_h = char_img.size
-                paste_x = slot_center_x - (img_w // 2)
-                paste_y = char_y_top
-
-                frame.paste(char_img, (paste_x, paste_y), char_img)
-
-        # --- Dialogue Layer ---
-        balloon_x = (video_width - balloon_img.width) // 2
-        frame.paste(balloon_img, (balloon_x, balloon_y), balloon_img)
+                paste_x = slot_center_x - (char_img.width // 2)
+                stage.paste(char_img, (paste_x, char_y_top), char_img)
+            
+            # --- Dialogue Layer ---
+            stage.paste(balloon_img, (balloon_x, balloon_y), balloon_img)
+            stages[active_key] = stage
         
+        frame = stage.copy()
         draw = ImageDraw.Draw(frame)
-        wrapper = textwrap.TextWrapper(width=30) 
-        wrapped_text = wrapper.fill(text=text_content)
+        wrapped_text = BALLOON_WRAPPER.fill(text=text_content)
         
         left, top, right, bottom = draw.textbbox((0, 0), wrapped_text, font=font)
         text_width = right - left
         text_height = bottom - top
         
-        balloon_center_x = video_width // 2
-        balloon_center_y = balloon_y + (balloon_img.height // 2)
-        
         text_x = balloon_center_x - (text_width // 2)
         text_y = balloon_center_y - (text_height // 2)
         text_color = "#000000"
@@ -505,101 +750,266 @@ def generate_frames(parsed_script: List[Dict[str, Any]], roster: List[str], conf
             align="center"
         )
         
-        frame_filename = f"frame_{i}.png"
-        frame_path = os.path.join(output_dir, frame_filename)
-        frame.save(frame_path)
-        
-        line['image_path'] = frame_path
+        frame_cache[(active_key, text_content)] = frame
+        if len(frame_cache) > FRAME_CACHE_SIZE:
+            frame_cache.popitem(last=False)
         
-        if progress_callback:
-            progress_callback((i + 1) / total_lines)
+        yield frame
+
+@functools.lru_cache(maxsize=None)
+def get_available_encoders() -> frozenset:
+    """
+    Names of the video encoders compiled into the local ffmpeg (probed once).
+    """
+    try:
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, check=True)
+    except Exception as e:
+        logger.warning(f"Could not list ffmpeg encoders: {e}")
+        return frozenset()
+    
+    # Lines look like: " V....D h264_nvenc           NVIDIA NVENC H.264 encoder"
+    encoders = set()
+    for row in result.stdout.splitlines():
+        parts = row.split()
+        if len(parts) >= 2 and parts[0].startswith("V"):
+            encoders.add(parts[1])
+    return frozenset(encoders)
+
+@functools.lru_cache(maxsize=None)
+def encoder_works(video_codec: str) -> bool:
+    """
+    Whether video_codec can actually encode here (probed once with a tiny
+    clip). Hardware encoders are often compiled in without a usable device.
+    """
+    if video_codec not in get_available_encoders():
+        return False
+    try:
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "color=size=256x256:duration=0.2",
+             "-c:v", video_codec, "-f", "null", "-"],
+            capture_output=True, check=True, timeout=30
+        )
+        return True
+    except Exception as e:
+        logger.info(f"Encoder {video_codec} is not usable: {e}")
+        return False
+
+def get_video_encoder_kwargs(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    ffmpeg output kwargs for settings.video_codec (h264_nvenc, h264_qsv,
+    h264_videotoolbox, libx264 or "auto" for the first working hardware
+    encoder). Falls back to libx264 if the requested encoder cannot run;
+    settings.video_preset overrides the preset.
+    """
+    settings = config.get('settings', {})
+    video_codec = settings.get('video_codec', 'libx264')
+    
+    if video_codec == 'auto':
+        video_codec = next((c for c in HW_ENCODER_PREFERENCE if encoder_works(c)), 'libx264')
+    elif video_codec != 'libx264' and not encoder_works(video_codec):
+        logger.warning(f"Encoder {video_codec} not usable in ffmpeg, falling back to libx264.")
+        video_codec = 'libx264'
+    
+    kwargs = {'vcodec': video_codec}
+    kwargs.update(VIDEO_ENCODER_PARAMS.get(video_codec, {}))
+    if settings.get('video_preset'):
+        kwargs['preset'] = settings['video_preset']
+    return kwargs
+
+def get_segment_output_kwargs(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Output kwargs for script/still segments: SEGMENT_OUTPUT_KWARGS plus the
+    configured video encoder. Every segment goes through this so they stay
+    stream-copy compatible.
+    """
+    kwargs = dict(SEGMENT_OUTPUT_KWARGS)
+    kwargs.update(get_video_encoder_kwargs(config))
+    if kwargs['vcodec'] == 'libx264':
+        kwargs['tune'] = 'stillimage'
+    return kwargs
 
-    return parsed_script
+def _produce_frames(frames: Iterator[Image.Image], frame_queue: queue.Queue, stop_event: threading.Event):
+    """
+    Producer side of assemble_video: renders frames ahead of the encoder.
+    Puts raw RGB bytes per frame, then None; a rendering error is put instead.
+    """
+    try:
+        for frame in frames:
+            if stop_event.is_set():
+                return
+            frame_queue.put(frame.tobytes())
+        frame_queue.put(None)
+    except Exception as e:
+        frame_queue.put(e)
 
-def assemble_video(parsed_script: List[Dict[str, Any]], output_dir: str = "output", output_filename: str = "final_video.mp4", progress_callback: Optional[Callable[[float], None]] = None, config: Dict[str, Any] = None) -> Optional[str]:
+def assemble_video(parsed_script: List[Dict[str, Any]], roster: List[str], output_dir: str = "output", output_filename: str = "final_video.mp4", progress_callback: Optional[Callable[[float], None]] = None, config: Dict[str, Any] = None, masked_text: Optional[str] = None) -> Optional[str]:
     """
     4. Assembly Logic
-    Combines frames and audio into video segments, then concatenates them.
+    One ffmpeg pass: frames from render_frames are piped in as raw RGB, each
+    repeated for the length of its line; the line audio is joined into one WAV.
+    masked_text is passed through to render_frames (Blind Listening part).
     """
     logger.info("Starting video assembly...")
     
     if config is None:
         config = load_config()
 
-    video_codec = config.get('settings', {}).get('video_codec', 'libx264')
-    logger.info(f"Using Video Codec: {video_codec}")
+    output_kwargs = get_segment_output_kwargs(config)
+    logger.info(f"Using Video Codec: {output_kwargs['vcodec']}")
     
-    temp_dir = os.path.join(output_dir, "temp")
+    # Scoped per output file so concurrent assemblies don't clobber each other.
+    temp_dir = os.path.join(output_dir, "temp", os.path.splitext(output_filename)[0])
     os.makedirs(temp_dir, exist_ok=True)
     
-    segment_files = []
-    total_lines = len(parsed_script)
-    
+    lines = []
     for i, line in enumerate(parsed_script):
-        image_path = line.get('image_path')
-        audio_path = line.get('audio_file') or line.get('audio_path')
-        
-        if not image_path or not audio_path:
-            logger.warning(f"Skipping line {i} due to missing assets. Image: {image_path}, Audio: {audio_path}")
+        if not line.get('audio_pcm'):
+            logger.warning(f"Skipping line {i}: no audio.")
             continue
-            
-        segment_filename = f"segment_{i}.mp4"
-        segment_path = os.path.join(temp_dir, segment_filename)
-        segment_path = os.path.abspath(segment_path)
-        image_path = os.path.abspath(image_path)
-        audio_path = os.path.abspath(audio_path)
+        lines.append(line)
         
-        try:
-            input_image = ffmpeg.input(image_path, loop=1)
-            input_audio = ffmpeg.input(audio_path)
-            
-            stream = ffmpeg.output(
-                input_image, 
-                input_audio, 
-                segment_path, 
-                vcodec='libx264',
-                acodec='aac',
-                pix_fmt='yuv420p',
-                shortest=None,
-                tune='stillimage'
-            )
-            
-            stream.run(overwrite_output=True, quiet=True)
-            segment_files.append(segment_path)
+    if not lines:
+        logger.error("No lines to assemble.")
+        return None
+        
+    final_output = os.path.abspath(os.path.join(output_dir, output_filename))
+    
+    # stdin carries the video, so the audio goes through a single file
+    audio_path = os.path.abspath(os.path.join(temp_dir, "audio.wav"))
+    with wave.open(audio_path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(TTS_SAMPLE_RATE)
+        for line in lines:
+            wav.writeframes(line['audio_pcm'])
+    
+    width, height = VIDEO_SIZE
+    video = ffmpeg.input('pipe:', format='rawvideo', pix_fmt='rgb24', s=f"{width}x{height}", framerate=VIDEO_FPS)
+    audio = ffmpeg.input(audio_path)
+    try:
+        process = (
+            ffmpeg
+            .output(video, audio, final_output, **output_kwargs)
+            .global_args('-loglevel', 'error', '-nostats')
+            .run_async(pipe_stdin=True, pipe_stderr=True, overwrite_output=True)
+        )
+    except Exception as e:
+        logger.error(f"Could not start ffmpeg for {output_filename}: {e}", exc_info=True)
+        return None
+    
+    # Render in a producer thread while this one feeds ffmpeg; the bounded
+    # queue makes a slow encoder throttle rendering instead of piling up frames.
+    frame_queue = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+    stop_event = threading.Event()
+    producer = threading.Thread(
+        target=_produce_frames,
+        args=(render_frames(lines, roster, config, masked_text=masked_text), frame_queue, stop_event),
+        daemon=True
+    )
+    producer.start()
+    
+    logger.info(f"Encoding {len(lines)} lines...")
+    try:
+        # Frame counts come from the cumulative end time, so rounding never drifts from the audio
+        elapsed = 0.0
+        frames_written = 0
+        rendered = 0
+        for line in lines:
+            frame_bytes = frame_queue.get()
+            if frame_bytes is None:
+                break
+            if isinstance(frame_bytes, Exception):
+                raise frame_bytes
             
-        except ffmpeg.Error as e:
-            logger.error(f"FFmpeg Error on segment {i}: {e.stderr.decode() if e.stderr else str(e)}")
-            continue
-        except Exception as e:
-            logger.error(f"Error creating segment {i}: {e}", exc_info=True)
-            continue
+            elapsed += get_pcm_duration(line['audio_pcm'])
+            frame_count = round(elapsed * VIDEO_FPS) - frames_written
+            for _ in range(frame_count):
+                process.stdin.write(frame_bytes)
+            frames_written += frame_count
+            rendered += 1
             
-        if progress_callback:
-            progress_callback((i + 1) / total_lines)
+            if progress_callback:
+                progress_callback(rendered / len(lines))
+    except BrokenPipeError:
+        # ffmpeg exited early; its stderr below says why
+        pass
+    except Exception as e:
+        logger.error(f"Error rendering frames for {output_filename}: {e}", exc_info=True)
+    finally:
+        # Unblock the producer if we stopped early
+        stop_event.set()
+        while True:
+            try:
+                frame_queue.get_nowait()
+            except queue.Empty:
+                break
+        producer.join()
         
-    if not segment_files:
-        logger.error("No segments created.")
+        process.stdin.close()
+        stderr = process.stderr.read()
+        process.wait()
+        
+    if process.returncode != 0:
+        logger.error(f"FFmpeg Error assembling {output_filename}: {stderr.decode(errors='replace')}")
+        return None
+    if rendered < len(lines):
+        logger.error(f"Only {rendered}/{len(lines)} frames rendered for {output_filename}.")
         return None
         
-    final_output = os.path.join(output_dir, output_filename)
-    final_output = os.path.abspath(final_output)
-    
-    logger.info(f"Concatenating {len(segment_files)} segments...")
+    return final_output
+
+@functools.lru_cache(maxsize=256)
+def _probe_cached(path: str, mtime_ns: int, size: int) -> Dict[str, Any]:
+    return ffmpeg.probe(path)
+
+def probe_media(path: str) -> Dict[str, Any]:
+    """
+    ffprobe result for path, memoized while the file is unchanged (same
+    mtime/size), so reused clips like the intro are only probed once.
+    """
+    stat = os.stat(path)
+    return _probe_cached(path, stat.st_mtime_ns, stat.st_size)
+
+def get_stream_signature(path: str) -> Tuple:
+    """
+    Helper: the stream parameters that must match for a stream-copy concat.
+    """
+    probe = probe_media(path)
+    signature = []
+    for stream in probe.get('streams', []):
+        if stream.get('codec_type') == 'video':
+            signature.append(('video', stream.get('codec_name'), stream.get('profile'), stream.get('width'), stream.get('height'), stream.get('pix_fmt'), stream.get('r_frame_rate')))
+        elif stream.get('codec_type') == 'audio':
+            signature.append(('audio', stream.get('codec_name'), stream.get('sample_rate'), stream.get('channels')))
+    return tuple(signature)
+
+def concat_videos(video_paths: List[str], output_path: str, config: Dict[str, Any] = None) -> Optional[str]:
+    """
+    Joins MP4s that share codec parameters (e.g. our own segments) with the
+    concat demuxer. Streams are copied, nothing is re-encoded.
+    If the inputs disagree, falls back to a re-encode through compose_video.
+    """
+    output_path = os.path.abspath(output_path)
+    list_path = f"{os.path.splitext(output_path)[0]}_list.txt"
     
     try:
-        list_path = os.path.join(temp_dir, "file_list.txt")
+        signatures = {get_stream_signature(os.path.abspath(path)) for path in video_paths}
+        if len(signatures) > 1:
+            logger.info(f"Inputs for {os.path.basename(output_path)} differ in codec parameters, re-encoding.")
+            return compose_video([{"path": path} for path in video_paths], output_path, config if config is not None else load_config())
+        
         with open(list_path, 'w') as f:
-            for seg in segment_files:
-                f.write(f"file '{seg.replace(os.sep, '/')}'\n")
+            for path in video_paths:
+                f.write(f"file '{os.path.abspath(path).replace(os.sep, '/')}'\n")
                 
         (
             ffmpeg
             .input(list_path, format='concat', safe=0)
-            .output(final_output, c='copy')
+            .output(output_path, c='copy')
             .run(overwrite_output=True, quiet=True)
         )
         
-        return final_output
+        return output_path
         
     except ffmpeg.Error as e:
         logger.error(f"FFmpeg Concat Error: {e.stderr.decode() if e.stderr else str(e)}", exc_info=True)
@@ -607,24 +1017,195 @@ def assemble_video(parsed_script: List[Dict[str, Any]], output_dir: str = "outpu
     except Exception as e:
         logger.error(f"Error assembling video: {e}", exc_info=True)
         return None
+    finally:
+        if os.path.exists(list_path):
+            os.remove(list_path)
 
-def create_separator_clip(config: Dict[str, Any], output_dir: str = "output"):
+def encode_still_segment(image: Union[str, np.ndarray], output_path: str, duration: Optional[float] = None, audio_path: Optional[str] = None, config: Dict[str, Any] = None) -> Optional[str]:
     """
-    Creates the 'Check your understanding...' separator clip.
-    Returns an ImageClip (1.0s).
+    Encodes a single still (PNG path or in-memory RGB/RGBA array) into an MP4
+    with the same parameters as the script segments, so it can be stream-copied
+    next to them. Length follows audio_path if given, else `duration` of silence.
     """
-    filename = "separator.png"
-    filepath = os.path.join(output_dir, filename)
-    filepath = os.path.abspath(filepath)
+    if config is None:
+        config = load_config()
     
-    width, height = 1080, 1920
+    output_path = os.path.abspath(output_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    
+    stdin_bytes = None
+    if isinstance(image, np.ndarray):
+        # Raw frame over stdin: no PNG encode/decode, looped for the whole segment
+        height, width = image.shape[:2]
+        pix_fmt = 'rgba' if image.shape[2] == 4 else 'rgb24'
+        video = ffmpeg.input('pipe:', format='rawvideo', pix_fmt=pix_fmt, s=f"{width}x{height}", framerate=VIDEO_FPS)\
+            .filter('loop', loop=-1, size=1, start=0)
+        stdin_bytes = np.ascontiguousarray(image).tobytes()
+    else:
+        video = ffmpeg.input(os.path.abspath(image), loop=1, framerate=VIDEO_FPS)
+    
+    if audio_path:
+        audio = ffmpeg.input(os.path.abspath(audio_path)).audio
+        length_kwargs = {'shortest': None}
+    else:
+        audio = ffmpeg.input(f"anullsrc=r={AUDIO_SAMPLE_RATE}:cl=stereo", format='lavfi').audio
+        length_kwargs = {'t': duration or 1.0}
+    
+    try:
+        (
+            ffmpeg
+            .output(video, audio, output_path, **length_kwargs, **get_segment_output_kwargs(config))
+            .run(input=stdin_bytes, overwrite_output=True, quiet=True)
+        )
+        return output_path
+    except ffmpeg.Error as e:
+        logger.error(f"FFmpeg Error on still segment {output_path}: {e.stderr.decode() if e.stderr else str(e)}")
+        return None
+    except Exception as e:
+        logger.error(f"Error creating still segment {output_path}: {e}", exc_info=True)
+        return None
+
+def resize_video(input_path: str, output_path: str) -> Optional[str]:
+    """
+    Re-encodes a video to VIDEO_SIZE / VIDEO_FPS once, so callers can reuse it
+    without scaling it again. Skipped when output_path is newer than the input.
+    """
+    input_path = os.path.abspath(input_path)
+    output_path = os.path.abspath(output_path)
+    if os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(input_path):
+        return output_path
+    
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    width, height = VIDEO_SIZE
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.mp4"
+    try:
+        source = ffmpeg.input(input_path)
+        video = source.video.filter('scale', width, height).filter('setsar', 1)
+        probe = probe_media(input_path)
+        streams = [video]
+        if any(s.get('codec_type') == 'audio' for s in probe.get('streams', [])):
+            streams.append(source.audio)
+        (
+            ffmpeg
+            .output(*streams, tmp_path, vcodec='libx264', acodec='aac', pix_fmt='yuv420p', r=VIDEO_FPS, ar=AUDIO_SAMPLE_RATE, ac=2, crf=18)
+            .run(overwrite_output=True, quiet=True)
+        )
+        os.replace(tmp_path, output_path)
+        return output_path
+    except ffmpeg.Error as e:
+        logger.error(f"FFmpeg Error resizing {input_path}: {e.stderr.decode() if e.stderr else str(e)}")
+        return None
+    except Exception as e:
+        logger.error(f"Error resizing {input_path}: {e}", exc_info=True)
+        return None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def get_intro_clip(intro_path: str = "assets/intro.mp4") -> Optional[str]:
+    """
+    The intro scaled to VIDEO_SIZE, rendered once into ASSET_CACHE_DIR and
+    reused by every run. Falls back to the original file if scaling fails.
+    """
+    if not os.path.exists(intro_path):
+        return None
+    width, height = VIDEO_SIZE
+    cached_path = resize_video(intro_path, os.path.join(ASSET_CACHE_DIR, f"intro_{width}x{height}.mp4"))
+    return cached_path or intro_path
+
+def compose_video(clips: List[Dict[str, Any]], output_path: str, config: Dict[str, Any], overlay_path: Optional[str] = None, title_overlay: Optional[np.ndarray] = None, music_path: Optional[str] = None) -> Optional[str]:
+    """
+    5. Final Composition
+    One ffmpeg pass: concat all clips, burn in the branding overlay (centered at
+    the bottom) and the title flash (first second), optionally mix in music.
+    Each clip is a dict with 'path' and optional 'trim_end' (seconds cut off the end).
+    """
+    logger.info(f"Composing {len(clips)} clips into {output_path}...")
+    
+    width, height = VIDEO_SIZE
+    output_path = os.path.abspath(output_path)
+    
+    try:
+        parts = []
+        total_duration = 0.0
+        
+        for clip in clips:
+            path = os.path.abspath(clip['path'])
+            probe = probe_media(path)
+            duration = float(probe['format']['duration'])
+            if clip.get('trim_end') and duration > 1:
+                duration -= clip['trim_end']
+            has_audio = any(s.get('codec_type') == 'audio' for s in probe.get('streams', []))
+            
+            # Normalize every clip to the same geometry/rate/layout so concat accepts them
+            source = ffmpeg.input(path, t=duration)
+            video = source.video\
+                .filter('scale', width, height)\
+                .filter('setsar', 1)\
+                .filter('fps', fps=VIDEO_FPS)\
+                .filter('format', 'yuv420p')
+            if has_audio:
+                audio = source.audio
+            else:
+                audio = ffmpeg.input(f"anullsrc=r={AUDIO_SAMPLE_RATE}:cl=stereo", format='lavfi', t=duration).audio
+            audio = audio.filter('aresample', AUDIO_SAMPLE_RATE).filter('aformat', channel_layouts='stereo')
+            
+            parts.extend([video, audio])
+            total_duration += duration
+        
+        joined = ffmpeg.concat(*parts, v=1, a=1).node
+        video, audio = joined[0], joined[1]
+        
+        # Branding
+        if overlay_path and os.path.exists(overlay_path):
+            logo = ffmpeg.input(os.path.abspath(overlay_path))
+            video = video.overlay(logo, x='(W-w)/2', y='H-h')
+        
+        # Social Title Overlay (Text Flash): single raw RGBA frame over stdin
+        stdin_bytes = None
+        if title_overlay is not None:
+            t_height, t_width = title_overlay.shape[:2]
+            title = ffmpeg.input('pipe:', format='rawvideo', pix_fmt='rgba', s=f"{t_width}x{t_height}")
+            video = video.overlay(title, x=0, y=0, enable='between(t,0,1)')
+            stdin_bytes = np.ascontiguousarray(title_overlay).tobytes()
+        
+        # Music: looped, ducked to 12%, faded out over the last 2s
+        if music_path:
+            logger.info(f"Adding background music: {os.path.basename(music_path)}")
+            music = ffmpeg.input(os.path.abspath(music_path), stream_loop=-1).audio.filter('volume', 0.12)
+            if total_duration > 2:
+                music = music.filter('afade', t='out', st=total_duration - 2.0, d=2.0)
+            audio = ffmpeg.filter([audio, music], 'amix', inputs=2, duration='first', normalize=0)
+        
+        output_kwargs = {'acodec': 'aac', 'pix_fmt': 'yuv420p', 'r': VIDEO_FPS}
+        output_kwargs.update(get_video_encoder_kwargs(config))
+        
+        (
+            ffmpeg
+            .output(video, audio, output_path, **output_kwargs)
+            .run(input=stdin_bytes, overwrite_output=True, quiet=True)
+        )
+        return output_path
+        
+    except ffmpeg.Error as e:
+        logger.error(f"FFmpeg Compose Error: {e.stderr.decode() if e.stderr else str(e)}", exc_info=True)
+        return None
+    except Exception as e:
+        logger.error(f"Error composing video: {e}", exc_info=True)
+        return None
+
+def create_separator_img(config: Dict[str, Any]) -> np.ndarray:
+    """
+    Creates the 'Check your understanding...' separator frame (RGB array).
+    """
+    width, height = VIDEO_SIZE
     img = Image.new('RGB', (width, height), color='black')
     draw = ImageDraw.Draw(img)
     
     settings = config.get('settings', {})
     font_path = settings.get('font_path', 'arial.ttf')
     try:
-        font = ImageFont.truetype(font_path, 80)
+        font = get_font(font_path, 80)
     except:
         font = ImageFont.load_default()
         
@@ -637,90 +1218,58 @@ def create_separator_clip(config: Dict[str, Any], output_dir: str = "output"):
     y = (height - text_h) // 2
     
     draw.text((x, y), text, font=font, fill="white")
-    img.save(filepath)
     
-    if os.path.exists(filepath):
-        clip = ImageClip(filepath).with_duration(1.0)
-        return clip
-    return None
+    return np.array(img)
 
-def add_background_music(video_clip, assets_dir: str = "assets"):
+def pick_background_music(assets_dir: str = "assets") -> Optional[str]:
     """
-    Adds background music to a video clip.
+    Picks a random background track (.mp3) from the assets folder.
     """
     if not os.path.exists(assets_dir):
-        return video_clip
+        return None
 
     music_files = [f for f in os.listdir(assets_dir) if f.lower().endswith(".mp3")]
     
     if not music_files:
         logger.warning("No background music found in assets/")
-        return video_clip
-        
-    bg_music_name = random.choice(music_files)
-    bg_music_path = os.path.join(assets_dir, bg_music_name)
-    logger.info(f"Adding background music: {bg_music_name}")
-    
-    try:
-        music = AudioFileClip(bg_music_path)
-        music = music.with_effects([AudioLoop(duration=video_clip.duration)])
-        music = music.with_volume_scaled(0.12)
-        
-        if video_clip.duration > 2:
-             music = music.with_effects([AudioFadeOut(duration=2.0)])
-             
-        original_audio = video_clip.audio
-        if original_audio:
-            final_audio = CompositeAudioClip([original_audio, music])
-        else:
-            final_audio = music
-            
-        video_clip.audio = final_audio
-        return video_clip
+        return None
         
-    except Exception as e:
-        logger.error(f"Failed to add background music: {e}", exc_info=True)
-        return video_clip
+    return os.path.join(assets_dir, random.choice(music_files))
 
-def cleanup_workspace():
+def cleanup_workspace(output_dir: str = "output", temp_dir: str = "temp"):
     """
     Deletes temporary directories and files used during generation.
+    output_dir is the pipeline workspace, temp_dir the vocab asset folder.
     """
     logger.info("Starting workspace cleanup...")
     
-    dirs_to_clean = [
-        os.path.join("output", "temp"),
-        os.path.join("output", "frames_web"),
-        os.path.join("output", "frames_listening"),
-        os.path.join("output", "frames_reading"),
-        "temp"
-    ]
+    output_subdirs = ["temp"]
+    
+    # One directory scan tells us which subdirs actually exist,
+    # instead of stat-ing every candidate path.
+    try:
+        with os.scandir(output_dir) as it:
+            entries = list(it)
+    except FileNotFoundError:
+        entries = []
+    
+    existing_dirs = {e.name for e in entries if e.is_dir(follow_symlinks=False)}
+    dirs_to_clean = [os.path.join(output_dir, d) for d in output_subdirs if d in existing_dirs]
+    if os.path.exists(temp_dir):
+        dirs_to_clean.append(temp_dir)
     
     for d in dirs_to_clean:
-        if os.path.exists(d):
-            try:
-                shutil.rmtree(d, ignore_errors=True)
-            except Exception as e:
-                logger.warning(f"Failed to remove {d}: {e}")
-                
-    output_dir = "output"
-    if os.path.exists(output_dir):
-        files = os.listdir(output_dir)
-        for f in files:
-            if f.startswith("audio_") and f.endswith(".mp3"):
-                file_path = os.path.join(output_dir, f)
-                try:
-                    os.remove(file_path)
-                except Exception as e:
-                    logger.warning(f"Failed to remove {file_path}: {e}")
-
-def create_title_card(text: str, config: Dict[str, Any]) -> str:
+        try:
+            shutil.rmtree(d, ignore_errors=True)
+        except Exception as e:
+            logger.warning(f"Failed to remove {d}: {e}")
+
+def create_title_card(text: str, config: Dict[str, Any]) -> np.ndarray:
     """
     Creates the title card for the Web Video.
+    Returns the RGB frame as an array (piped straight to ffmpeg, no PNG).
     """
     logger.info("Creating Title Card...")
-    output_path = os.path.join("output", "temp", "title_card.png")
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
     bg_path = "assets/lesson.png"
     target_size = (1080, 1920)
@@ -742,7 +1291,7 @@ def create_title_card(text: str, config: Dict[str, Any]) -> str:
     font_path = settings.get('font_path', 'arial.ttf')
     font_size = 100 
     try:
-        font = ImageFont.truetype(font_path, font_size)
+        font = get_font(font_path, font_size)
     except:
         font = ImageFont.load_default()
         
@@ -762,16 +1311,14 @@ def create_title_card(text: str, config: Dict[str, Any]) -> str:
     
     draw.multiline_text((x, y), wrapped_text, font=font, fill="#333333", align="center")
     
-    img.save(output_path)
-    return output_path
+    return np.array(img)
 
-def create_social_title_img(text: str, config: Dict[str, Any]) -> str:
+def create_social_title_img(text: str, config: Dict[str, Any]) -> np.ndarray:
     """
     Creates a transparent overlay with the lesson title for Social Video.
+    Returns the RGBA frame as an array; the alpha channel drives the overlay.
     """
     logger.info("Creating Social Title Overlay...")
-    output_path = os.path.join("output", "temp", "social_title_overlay.png")
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
     width, height = 1080, 1920
     logger.info("Creating Image object...")
@@ -783,7 +1330,7 @@ def create_social_title_img(text: str, config: Dict[str, Any]) -> str:
     font_size = 90
     logger.info(f"Loading font {font_path}...")
     try:
-        font = ImageFont.truetype(font_path, font_size)
+        font = get_font(font_path, font_size)
     except:
         logger.warning("Font load failed, using default.")
         font = ImageFont.load_default()
@@ -811,12 +1358,4 @@ def create_social_title_img(text: str, config: Dict[str, Any]) -> str:
         stroke_fill="black"
     )
 
-    logger.info(f"Saving Social Title Overlay to {output_path}...")
-    try:
-        img.save(output_path)
-        logger.info("Image saved successfully.")
-    except Exception as e:
-        logger.error(f"Failed to save Social Title Overlay: {e}")
-        raise e
-        
-    return output_path
+    return np.array(img)
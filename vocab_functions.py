@@ -2,32 +2,151 @@ import logging
 import streamlit as st
 import os
 import asyncio
+import functools
+import hashlib
+import json
+import uuid
 import edge_tts
+import ffmpeg
+try:
+    import uvloop  # optional, uvloop>=0.19; not available on Windows
+except ImportError:
+    uvloop = None
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
-from moviepy import ImageClip, CompositeVideoClip, ColorClip, concatenate_videoclips, AudioFileClip, AudioClip, concatenate_audioclips
+
+import video_engine
 
 logger = logging.getLogger(__name__)
 
 # --- Vocabulary Video Functions ---
 
-async def _edge_tts_generate(text, voice, output_file):
-    """Async helper for edge-tts"""
+VOCAB_VOICE = "en-US-ChristopherNeural"
+VOCAB_PAUSE = 0.3  # seconds of silence after each word
+
+def _edge_tts_cache_path(text, voice):
+    """Content-addressed MP3 location in the shared TTS cache"""
+    payload = json.dumps({"text": text, "voice": voice, "engine": "edge-tts"}, sort_keys=True)
+    cache_key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return os.path.join(video_engine.TTS_CACHE_DIR, f"{cache_key}.mp3")
+
+async def _edge_tts_generate(text, voice):
+    """Async helper for edge-tts: returns the MP3 bytes, from the TTS cache when possible"""
+    cache_path = _edge_tts_cache_path(text, voice)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            audio = f.read()
+        video_engine.touch_cache_entry(cache_path)
+        return audio
+    
     communicate = edge_tts.Communicate(text, voice)
-    await communicate.save(output_file)
+    chunks = []
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            chunks.append(chunk["data"])
+    audio = b"".join(chunks)
+    
+    # Populate the cache atomically; only complete responses are stored
+    if audio:
+        try:
+            os.makedirs(video_engine.TTS_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            logger.warning(f"Could not write TTS cache entry {cache_path}: {e}")
+    return audio
+
+async def _edge_tts_generate_all(texts, voice):
+    """Runs all downloads concurrently on one loop; errors are returned, not raised"""
+    return await asyncio.gather(
+        *(_edge_tts_generate(text, voice) for text in texts),
+        return_exceptions=True
+    )
+
+@functools.lru_cache(maxsize=None)
+def _silence_mp3(duration):
+    """MP3 silence matching edge-tts output (24 kHz mono, 48 kbps), encoded once for byte-level joins"""
+    cache_path = os.path.join(video_engine.ASSET_CACHE_DIR, f"silence_{int(duration * 1000)}ms_24k.mp3")
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            return f.read()
+    
+    out, _ = (
+        ffmpeg
+        .input("anullsrc=r=24000:cl=mono", format="lavfi", t=duration)
+        .output("pipe:", format="mp3", acodec="libmp3lame", audio_bitrate="48k", write_xing=0, id3v2_version=0)
+        .run(capture_stdout=True, quiet=True)
+    )
+    
+    # Keep it on disk so later processes (batch workers, app restarts) skip ffmpeg entirely
+    try:
+        os.makedirs(video_engine.ASSET_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(out)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"Could not write silence cache {cache_path}: {e}")
+    return out
+
+@functools.lru_cache(maxsize=None)
+def _load_base_rgb(path):
+    """Decoded base slide, shared across runs; callers draw on a .copy()"""
+    img = Image.open(path).convert("RGB")
+    img.readonly = 1
+    return img
+
+@functools.lru_cache(maxsize=None)
+def _resolve_font_path():
+    """Finds a usable font once: assets/font.ttf, else the first system candidate that loads"""
+    font_path_main = "assets/font.ttf"
+    if os.path.exists(font_path_main):
+        return font_path_main
+    for c in ["arialbd.ttf", "arial.ttf", "SegoeUI.ttf", "Roboto-Bold.ttf"]:
+        try:
+            video_engine.get_font(c, 50)
+            return c
+        except OSError:
+            continue
+    return None
+
+@functools.lru_cache(maxsize=None)
+def _default_font():
+    """Pillow's built-in fallback font, loaded once"""
+    return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=2048)
+def _text_bbox(text, font):
+    """Memoized textbbox at (0, 0); fonts come from get_font or _default_font, both cached, so the object is a stable key"""
+    return font.getbbox(text)
 
-def generate_vocab_assets(vocab_list):
+@functools.lru_cache(maxsize=256)
+def _badge_stamp(width, height, radius, color):
+    """Rounded badge rasterized once per size/colour; pasted with itself as the mask"""
+    badge = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    bdraw = ImageDraw.Draw(badge)
+    try:
+        bdraw.rounded_rectangle([0, 0, width - 1, height - 1], radius=radius, fill=color)
+    except AttributeError:
+        bdraw.rectangle([0, 0, width - 1, height - 1], fill=color)
+    badge.readonly = 1
+    return badge
+
+def generate_vocab_assets(vocab_list, temp_dir="temp"):
     """
     Phase 1: Asset Factory - Single Summary Slide Strategy
     Generates:
-      1. A single summary slide (PNG) with all words (Badges + Text).
+      1. A single summary slide (in-memory RGB array) with all words (Badges + Text).
       2. A single concatenated audio file (MP3) with all pronunciations + silence.
-    Returns a dict with paths to these two assets.
+    Returns a dict with the slide array and the audio path.
     """
+    
     st.info("Generating Vocabulary Assets (Summary Slide)...")
     logger.info("Generating Vocabulary Assets (Summary Slide)...")
     
     # 1. Init Temp
-    temp_dir = "temp"
     os.makedirs(temp_dir, exist_ok=True)
     
     # Base Image
@@ -38,7 +157,7 @@ def generate_vocab_assets(vocab_list):
         return None
         
     try:
-        img = Image.open(base_image_path).convert("RGBA")
+        img = _load_base_rgb(base_image_path).copy()
     except Exception as e:
         st.error(f"Failed to load base image: {e}")
         logger.error(f"Failed to load base image: {e}", exc_info=True)
@@ -46,32 +165,22 @@ def generate_vocab_assets(vocab_list):
 
     draw = ImageDraw.Draw(img)
     
-    # Fonts Setup
-    font_path_main = "assets/font.ttf"
-    if not os.path.exists(font_path_main):
-        # Fallback candidates
-        candidates = ["arialbd.ttf", "arial.ttf", "SegoeUI.ttf", "Roboto-Bold.ttf"]
-        for c in candidates:
-             try:
-                 ImageFont.truetype(c, 50) 
-                 font_path_main = c
-                 break
-             except:
-                 continue
+    # Fonts Setup (path probe and faces are cached across runs)
+    font_path_main = _resolve_font_path()
     
     font_size_word = 100 # Slightly smaller than before to ensure fit if 5 items
     font_size_trans = 70
     
     if font_path_main:
         try:
-            font_word = ImageFont.truetype(font_path_main, font_size_word)
-            font_trans = ImageFont.truetype(font_path_main, font_size_trans)
+            font_word = video_engine.get_font(font_path_main, font_size_word)
+            font_trans = video_engine.get_font(font_path_main, font_size_trans)
         except:
-            font_word = ImageFont.load_default()
-            font_trans = ImageFont.load_default()
+            font_word = _default_font()
+            font_trans = _default_font()
     else:
-         font_word = ImageFont.load_default()
-         font_trans = ImageFont.load_default()
+         font_word = _default_font()
+         font_trans = _default_font()
 
     # Layout Config
     start_y = 670
@@ -84,30 +193,35 @@ def generate_vocab_assets(vocab_list):
     text_color_word = "#FFFFFF"
     text_color_trans = "#000000"
     
-    audio_clips = []
+    audio_parts = []
+    
+    # Pass 1: fetch every pronunciation concurrently (network-bound, one event loop)
+    words = [item.get('word') or 'Unknown' for item in vocab_list]
+    # uvloop.run only swaps the loop for this call; the global policy (Streamlit's) is untouched
+    run_loop = uvloop.run if uvloop else asyncio.run
+    audio_results = run_loop(_edge_tts_generate_all(words, VOCAB_VOICE))
+    video_engine.trim_tts_cache()
     
-    # Process Items
+    try:
+        silence = _silence_mp3(VOCAB_PAUSE)
+    except Exception as e:
+        logger.warning(f"Could not encode the vocab pause, joining words without it: {e}")
+        silence = b""
+    
+    # Pass 2: collect audio and draw, in list order
     for i, item in enumerate(vocab_list):
-        word = item.get('word') or 'Unknown'
+        word = words[i]
         translation = item.get('translation') or 'Unknown'
         
         # --- A. Audio Part ---
-        audio_filename = f"vocab_audio_{i}.mp3"
-        audio_path = os.path.abspath(os.path.join(temp_dir, audio_filename))
-        
         try:
-            # Sync wrapper for edge-tts
-            asyncio.run(_edge_tts_generate(word, "en-US-ChristopherNeural", audio_path))
+            if isinstance(audio_results[i], Exception):
+                raise audio_results[i]
             
-            # Load as AudioFileClip
-            if os.path.exists(audio_path):
-                clip = AudioFileClip(audio_path)
-                audio_clips.append(clip)
-                
-                # Add Silence (0.3s)
-                # Using a silent list method compatible with moviepy
-                silence = AudioClip(lambda t: [0], duration=0.3, fps=44100)
-                audio_clips.append(silence)
+            # MP3 frames are self-contained, so word + pause bytes can simply be appended
+            if audio_results[i]:
+                audio_parts.append(audio_results[i])
+                audio_parts.append(silence)
                 
         except Exception as e:
             st.error(f"Audio gen failed for '{word}': {e}")
@@ -120,7 +234,7 @@ def generate_vocab_assets(vocab_list):
         # 1. Left Side: English Badge
         # We want the Right Edge of the badge to be at (center_axis_x - center_gap)
         
-        bbox = draw.textbbox((0, 0), word, font=font_word)
+        bbox = _text_bbox(word, font_word)
         text_w = bbox[2] - bbox[0]
         text_h = bbox[3] - bbox[1]
         
@@ -133,14 +247,10 @@ def generate_vocab_assets(vocab_list):
         badge_right_edge = center_axis_x - center_gap
         badge_x1 = badge_right_edge - badge_w
         badge_y1 = current_y
-        badge_x2 = badge_right_edge
-        badge_y2 = badge_y1 + badge_h
         
-        # Draw Rounded Rect
-        try:
-             draw.rounded_rectangle([badge_x1, badge_y1, badge_x2, badge_y2], radius=40, fill=badge_color)
-        except AttributeError:
-             draw.rectangle([badge_x1, badge_y1, badge_x2, badge_y2], fill=badge_color)
+        # Draw Rounded Rect (cached stamp; +1 because rounded_rectangle bounds are inclusive)
+        badge = _badge_stamp(badge_w + 1, badge_h + 1, 40, badge_color)
+        img.paste(badge, (badge_x1, badge_y1), badge)
              
         # Draw English Text (Centered in Badge)
         center_x_badge = badge_x1 + (badge_w // 2)
@@ -165,20 +275,19 @@ def generate_vocab_assets(vocab_list):
             draw.text((trans_x, trans_y_center), translation, font=font_trans, fill=text_color_trans, anchor="lm") # Left-Middle alignment
         except:
             # Fallback for older Pillow
-            bbox_t = draw.textbbox((0, 0), translation, font=font_trans)
+            bbox_t = _text_bbox(translation, font_trans)
             trans_h = bbox_t[3] - bbox_t[1]
             draw.text((trans_x, trans_y_center - (trans_h // 2)), translation, font=font_trans, fill=text_color_trans)
 
-    # Save Summary Image
-    summary_path = os.path.abspath(os.path.join(temp_dir, "vocab_summary_slide.png"))
-    img.save(summary_path)
+    # Summary Image stays in memory; encode_still_segment pipes it to ffmpeg raw
+    summary_slide = np.asarray(img)
     
-    # Concatenate Audio
+    # Concatenate Audio: one write, no decode/re-encode
     full_mix_path = os.path.abspath(os.path.join(temp_dir, "vocab_full_mix.mp3"))
-    if audio_clips:
+    if audio_parts:
         try:
-            final_audio = concatenate_audioclips(audio_clips)
-            final_audio.write_audiofile(full_mix_path, fps=44100, logger=None)
+            with open(full_mix_path, "wb") as f:
+                f.write(b"".join(audio_parts))
         except Exception as e:
             st.error(f"Audio concatenation failed: {e}")
             logger.error(f"Audio concatenation failed: {e}", exc_info=True)
@@ -187,38 +296,30 @@ def generate_vocab_assets(vocab_list):
         full_mix_path = None
         
     return {
-        "summary_slide": summary_path,
+        "summary_slide": summary_slide,
         "full_audio": full_mix_path
     }
 
-def create_vocab_video_sequence(assets):
+def create_vocab_video_sequence(assets, output_path, config=None):
     """
     Phase 2: Video Sequence - Single Slide
+    Encodes the summary slide for the length of the mixed audio, with the
+    caller's config so it uses the same encoder as the other segments.
+    Returns the path of the MP4 segment.
     """
     st.info("Assembling Vocabulary Summary...")
     
-    if not assets or not assets.get("summary_slide") or not assets.get("full_audio"):
+    if not assets or assets.get("summary_slide") is None or not assets.get("full_audio"):
         st.error("Missing vocab assets for sequence.")
         logger.error("Missing vocab assets for sequence.")
         return None
         
-    img_path = assets["summary_slide"]
+    slide = assets["summary_slide"]
     audio_path = assets["full_audio"]
     
-    try:
-        # Load Audio to get duration
-        audio_clip = AudioFileClip(audio_path)
-        duration = audio_clip.duration
-        
-        # Create Image Clip with exact duration
-        # Add a small buffer to duration if needed, or exact match
-        video_clip = ImageClip(img_path).with_duration(duration)
-        video_clip = video_clip.with_audio(audio_clip)
-        
-        return video_clip
-        
-    except Exception as e:
-        st.error(f"Failed to create vocab sequence: {e}")
-        logger.error(f"Failed to create vocab sequence: {e}", exc_info=True)
-        return None
-
+    # Same encoding as the story segments, so it concatenates cleanly
+    segment_path = video_engine.encode_still_segment(slide, output_path, audio_path=audio_path, config=config)
+    if not segment_path:
+        st.error("Failed to create vocab sequence.")
+        logger.error("Failed to create vocab sequence.")
+    return segment_path